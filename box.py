@@ -1,20 +1,27 @@
 import asyncio
 import json
 import os.path
-import time
+import re
 from collections import defaultdict, namedtuple
-from math import floor, ceil
-from sqlite3 import Connection
+from concurrent.futures import ThreadPoolExecutor
 from typing import *
 
 import websockets
 from websockets.client import WebSocketClientProtocol
 from websockets.exceptions import InvalidStatusCode
 
-import calc
+from calcpool import CalcPool
+from dispatch import Dispatcher
+from metrics import METRICS
+from outbox import Outbox
+from scheduler import Scheduler, COALESCE
 from krist import kauth
-from spymap import based
-from spymap.integration import get_configuration, get_updates
+from spymap import based, retention
+from spymap.integration import get_configuration
+from spymap.changes import ChunkStore, detect_changes, load_watched
+from spymap.simplify import REACH
+from spymap.structures import WatchedChunk
+from spymap.zones import ZoneEngine, load_zones
 
 DYNMAP_CONF = get_configuration()
 
@@ -25,6 +32,18 @@ with open('banlist.json') as f:
     BANNED = json.load(f)
 
 TARGET = f"wss://chat.sc3.io/v2/{key}"
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # serve Prometheus metrics on localhost; 0 to not
+DBHEALTH_SERIES = 10  # metrics shown in \dbhealth, by total time spent
+
+ZONE_WORLD = os.environ.get('ZONE_WORLD', 'world')  # internal dynmap name of the world zones.json is in
+if ZONE_WORLD not in {world.internal for world in DYNMAP_CONF.worlds}:
+    raise ValueError(f'zone world {ZONE_WORLD!r} is not on the map; dynmap has {[world.internal for world in DYNMAP_CONF.worlds]}')
+ZONES = ZoneEngine(load_zones('zones.json'), ZONE_WORLD)
+WATCHED = load_watched('watched.json')
+CHUNK_STORE = ChunkStore('chunks')
+WATCH_NOTIFY = 'penguinencounter'
+OUTBOX = Outbox()
+CALC_POOL = CalcPool()
 
 COMMANDS = defaultdict(list)
 
@@ -39,15 +58,10 @@ async def invoke(sock: WebSocketClientProtocol, data: dict):
     for handler in COMMANDS[data['command']]:
         if user in BANNED:
             print(f"User {user} is banned")
-            await sock.send(json.dumps({
-                'type': 'tell',
-                'user': data['user']['name'],
-                'name': 'calc',
-                'text': f'&cpermission error: {BANNED[user]}',
-                'mode': 'format'
-            }))
+            OUTBOX.tell(data['user']['name'], 'calc', f'&cpermission error: {BANNED[user]}')
             return
-        await handler(sock, data, data['args'])
+        with METRICS.timer('command', command=data['command']):
+            await handler(sock, data, data['args'])
 
 
 async def cmd_calc(sock: WebSocketClientProtocol, ctx: dict, args: List[str]):
@@ -56,114 +70,148 @@ async def cmd_calc(sock: WebSocketClientProtocol, ctx: dict, args: List[str]):
     print(f"Reply to {ctx['user']['name']} ({ctx['user']['uuid']})")
     # calculate the value
     try:
-        response = calc.eval_expr(st)
+        response = await CALC_POOL.evaluate(st)
         print(f"Got {response}")
-        # send the response
-        await sock.send(json.dumps({
-            'type': 'tell',
-            'user': ctx['user']['name'],
-            'name': 'calc',
-            'text': f'&e{st} = {response}',
-            'mode': 'format'
-        }))
-        print('Done')
+        text = f'&e{st} = {response}'
     except ValueError as e:
         print(f"Got ValueError")
-        await sock.send(json.dumps({
-            'type': 'tell',
-            'user': ctx['user']['name'],
-            'name': 'calc',
-            'text': f'&aFailed: {e}',
-            'mode': 'format'
-        }))
-        print('Done')
+        text = f'&aFailed: {e}'
     except TypeError:
-        await sock.send(json.dumps({
-            'type': 'tell',
-            'user': ctx['user']['name'],
-            'name': 'calc',
-            'text': f'&aFailed: bad input',
-            'mode': 'format'
-        }))
-        print('Done')
+        text = f'&aFailed: bad input'
     except Exception as e:
         print(e)
-        await sock.send(json.dumps({
-            'type': 'tell',
-            'user': ctx['user']['name'],
-            'name': 'calc',
-            'text': f'&asomething broke: {e}',
-            'mode': 'format'
-        }))
-        print('Done')
+        text = f'&asomething broke: {e}'
+    OUTBOX.tell(ctx['user']['name'], 'calc', text)
 
 
 async def cmd_whereis(sock: WebSocketClientProtocol, ctx: dict, args: List[str]):
     if len(args) != 1:
-        await sock.send(json.dumps({
-            'type': 'tell',
-            'user': ctx['user']['name'],
-            'name': 'whereis',
-            'text': r'&cFailed: invalid arguments; \whereis <player>',
-            'mode': 'format'
-        }))
+        OUTBOX.tell(ctx['user']['name'], 'whereis', r'&cFailed: invalid arguments; \whereis <player>')
         return
     name = args[0]
-    await sock.send(json.dumps({
-        'type': 'tell',
-        'user': ctx['user']['name'],
-        'name': 'whereis',
-        'text': based.player_report(name),
-        'mode': 'format'
-    }))
+    OUTBOX.tell(ctx['user']['name'], 'whereis', await based.player_report_async(name))
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+DURATION_RE = re.compile(r'(\d+)([smhd])')
+TRAIL_DEFAULT = 60 * 60
+TRAIL_MAX = 60 * 60 * 24 * 30
+
+
+def parse_duration(st: str) -> Optional[int]:
+    """'90s', '2h', '1d12h' -> seconds"""
+    if DURATION_RE.sub('', st.lower()) != '':
+        return None
+    return sum(int(n) * DURATION_UNITS[unit] for n, unit in DURATION_RE.findall(st.lower())) or None
+
+
+async def cmd_trail(sock: WebSocketClientProtocol, ctx: dict, args: List[str]):
+    duration = parse_duration(args[1]) if len(args) == 2 else TRAIL_DEFAULT
+    if len(args) not in (1, 2) or duration is None:
+        OUTBOX.tell(ctx['user']['name'], 'trail', r'&cFailed: invalid arguments; \trail <player> [duration, e.g. 30m, 2h, 1d]')
+        return
+    name = args[0]
+    await based.resolve_async(name)
+    report = await asyncio.get_running_loop().run_in_executor(None, based.trail_report, name, min(duration, TRAIL_MAX))
+    OUTBOX.tell(ctx['user']['name'], 'trail', report)
+
+
+NEAR_DEFAULT_RADIUS = 64
+NEAR_MIN_RADIUS = REACH  # Updates has a point at least this close to everywhere a player went
+NEAR_MAX_RADIUS = 1000
+NEAR_DEFAULT_DURATION = 60 * 60 * 24
+NEAR_WORLDS = {world.internal for world in DYNMAP_CONF.worlds}
+
+
+async def cmd_near(sock: WebSocketClientProtocol, ctx: dict, args: List[str]):
+    try:
+        x, z = float(args[0]), float(args[1])
+        radius = float(args[2]) if len(args) > 2 else NEAR_DEFAULT_RADIUS
+        duration = parse_duration(args[3]) if len(args) > 3 else NEAR_DEFAULT_DURATION
+        world = args[4] if len(args) > 4 else None
+        if len(args) > 5 or duration is None or not NEAR_MIN_RADIUS <= radius <= NEAR_MAX_RADIUS or (world is not None and world not in NEAR_WORLDS):
+            raise ValueError
+    except (IndexError, ValueError):
+        OUTBOX.tell(ctx['user']['name'], 'near', f'&cFailed: invalid arguments; \\near <x> <z> [radius, {NEAR_MIN_RADIUS:.0f} to {NEAR_MAX_RADIUS}] [duration] [world]')
+        return
+    report = await asyncio.get_running_loop().run_in_executor(
+        None, based.near_report, x, z, radius, min(duration, TRAIL_MAX), world)
+    OUTBOX.tell(ctx['user']['name'], 'near', report)
+
+
+async def cmd_jobs(sock: WebSocketClientProtocol, ctx: dict, _: List[str]):
+    if ctx['user']['name'].lower() != "penguinencounter":
+        return
+    OUTBOX.tell(ctx['user']['name'], 'jobs', JOBS.report() + '&7outbox: ' + OUTBOX.report() + '&7calc: ' + CALC_POOL.report())
 
 
 async def cmd_dbhealth(sock: WebSocketClientProtocol, ctx: dict, _: List[str]):
     print(ctx['user']['name'].lower(), 'requested db health')
     if ctx['user']['name'].lower() != "penguinencounter":
         return
-    await sock.send(json.dumps({
-        'type': 'tell',
-        'user': ctx['user']['name'],
-        'name': 'dbhealth',
-        'text': based.dbhealth_report(),
-        'mode': 'format'
-    }))
+    report = await asyncio.get_running_loop().run_in_executor(None, based.dbhealth_report)
+    OUTBOX.tell(ctx['user']['name'], 'dbhealth', report + METRICS.summary(DBHEALTH_SERIES))
+
 
+async def reject(sock: WebSocketClientProtocol, data: dict, reason: str):
+    OUTBOX.tell(data['user']['name'], data['command'], f'&c{reason}')
+
+
+DISPATCH = Dispatcher(invoke, reject)
 
 register('calc', cmd_calc)
 register('whereis', cmd_whereis)
+register('trail', cmd_trail)
+register('near', cmd_near)
 register('dbhealth', cmd_dbhealth)
+register('jobs', cmd_jobs)
 
 NameUUID = namedtuple('NameUUID', ['name', 'uuid'])
 player_cache: Set[NameUUID] = set()
 
 
+# krist.dev calls are blocking (requests); keep them off the event loop
+KRIST_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='krist')
+
+
 async def process_kauth(_: WebSocketClientProtocol):
-    kauth.read_incoming()
+    await asyncio.get_running_loop().run_in_executor(KRIST_EXECUTOR, kauth.read_incoming)
 
 
 async def track(_: WebSocketClientProtocol):
-    based.auto_fetch(DYNMAP_CONF)
+    listing = await based.auto_fetch_async(DYNMAP_CONF)
+    if listing is None:
+        return
+    for event in ZONES.tick(listing.frame, listing.diff, listing.base):
+        print(f'Zone {event.zone.name}: {event.player} {event.kind}')
+
+
+async def watch(sock: WebSocketClientProtocol):
+    loop = asyncio.get_running_loop()
+    for world in DYNMAP_CONF.worlds:
+        group = WATCHED.get(world.internal)
+        if not group:
+            continue
+        chunks, stack = await WatchedChunk.fetch_stack(group, world, CHUNK_STORE.priorities(world, group))
+        changes = await loop.run_in_executor(None, detect_changes, CHUNK_STORE, world, chunks, stack)
+        for change in changes:
+            OUTBOX.tell(WATCH_NOTIFY, 'watch', f'&e{change.changed} &7blocks changed near (&c{change.chunk.x * 32 + 16}&7, &c{change.chunk.z * -32 - 16}&7) in &a{world.external}')
+    await loop.run_in_executor(None, CHUNK_STORE.flush)
 
 
-tasks = {
-    2: [
-        process_kauth,
-        track
-    ]
-}
+async def retain(_: WebSocketClientProtocol):
+    await retention.apply_retention(based.get_database())
 
-last_tick = time.time()
 
+JOBS = Scheduler()
+JOBS.add(process_kauth, 2)
+JOBS.add(track, 2)
+JOBS.add(watch, 60, jitter=5, overrun=COALESCE)
+JOBS.add(retain, 3600, jitter=60)
 
-async def main(conn: Connection):
-    global tasks, last_tick, player_cache
-    cursor = conn.cursor()
-    based.player_init_tables(cursor)
-    #    based.fixup_updates(cursor)
-    conn.commit()
-    cursor.close()
+
+async def main():
+    global player_cache
     async with websockets.connect(TARGET) as websocket:
         websocket: WebSocketClientProtocol
         while True:
@@ -176,13 +224,14 @@ async def main(conn: Connection):
                 else:
                     raise RuntimeError('KO (for some reason, the Hello packet had ok=false).')
 
-        while True:
-            try:
-                message = await asyncio.wait_for(websocket.recv(), timeout=0.1)
+        sender = asyncio.create_task(OUTBOX.run(websocket))
+        JOBS.start(websocket)
+        try:
+            async for message in websocket:
                 data: dict = json.loads(message)
                 if 'event' in data.keys():
                     if data['event'] == 'command':
-                        await invoke(websocket, data)
+                        DISPATCH.dispatch(websocket, data)
                     elif data['event'] == 'join':
                         player_cache.add(NameUUID(data['user']['name'], data['user']['uuid']))
                     elif data['event'] == 'leave':
@@ -190,33 +239,26 @@ async def main(conn: Connection):
                             player_cache.remove(NameUUID(data['user']['name'], data['user']['uuid']))
                 elif 'error' in data.keys():
                     print('Error occurred. {}'.format(data['error']))
+                    if data['error'] == 'rate_limited':
+                        OUTBOX.backoff()
                 elif 'type' in data.keys() and data['type'] == 'players':
                     player_cache = set(map(lambda package: NameUUID(package['name'], package['uuid']), data['players']))
-            except asyncio.TimeoutError:
-                # Do other, background tasks here
-                current_tick = time.time()
-                for wait, jobs in tasks.items():
-                    # did we wait long enough?
-                    # over the whole numbered seconds between last_tick and current_tick
-                    # is that N seconds mod wait == 0?
-                    if wait == 0:
-                        for job in jobs:
-                            await job(websocket)
-                        return
-                    for i in range(ceil(last_tick), floor(current_tick) + 1):
-                        if i % wait == 0:
-                            for job in jobs:
-                                await job(websocket)
-                last_tick = current_tick
+        finally:
+            JOBS.stop()
+            sender.cancel()
 
 
 async def main_ka():
     from websockets.exceptions import ConnectionClosed, ConnectionClosedError, ConnectionClosedOK
     print(f'Keep-alive enabled...')
+    CALC_POOL.start()
+    based.get_database()
+    resolver = asyncio.create_task(based.RESOLVER.run())
+    if METRICS_PORT:
+        await METRICS.serve(METRICS_PORT)
     while True:
         try:
-            with based.player_connector() as conn:
-                await main(conn)
+            await main()
         except ConnectionClosedOK as e:
             print(f'Connection closed (ok) ({e.code}). Reconnecting...')
         except ConnectionClosedError as e:
@@ -1,6 +1,7 @@
 import ast
 import operator as op
-import functools
+from collections import OrderedDict
+from typing import *
 
 
 def is_integer(st):
@@ -17,6 +18,20 @@ operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
              ast.USub: op.neg, ast.BitAnd: op.and_, ast.BitOr: op.or_,
              ast.Invert: op.invert, ast.FloorDiv: op.floordiv}
 
+MAXVAL = 1e50
+MAXPOW = 100
+MAX_BITS = int(MAXVAL).bit_length()  # no integer result may be wider than MAXVAL
+MAX_LENGTH = 256  # characters, after normalising
+MAX_OPS = 64  # operators per expression
+CACHE_SIZE = 256
+
+# normalised expression -> (True, value) or (False, exception)
+_cache: 'OrderedDict[str, Tuple[bool, Any]]' = OrderedDict()
+
+
+def normalise(expr: str) -> str:
+    return ' '.join(expr.split())
+
 
 def eval_expr(expr):
     """
@@ -27,58 +42,98 @@ def eval_expr(expr):
     >>> eval_expr('1 + 2*3**(4^5) / (6 + -7)')
     -5.0
     """
-    return evil_(ast.parse(expr, mode='eval').body)
+    key = normalise(expr)
+    outcome = cached(key)
+    if outcome is None:
+        try:
+            outcome = (True, compile_expr(key))
+        except (ValueError, TypeError, ArithmeticError, SyntaxError) as e:
+            outcome = (False, e)
+        remember(key, *outcome)
+    ok, result = outcome
+    if ok:
+        return result
+    raise result.with_traceback(None)
 
 
-MAXVAL = 1e50
-MAXPOW = 100
+def cached(key: str) -> Optional[Tuple[bool, Any]]:
+    """Outcome of a normalised expression, if it's been worked out before."""
+    if key not in _cache:
+        return None
+    _cache.move_to_end(key)
+    return _cache[key]
 
 
-def eval_(node):
-    if isinstance(node, ast.Num):  # <number>
-        if node.n > MAXVAL:
-            raise ValueError(f"Value {node.n} is too large")
-        return node.n
-    elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
-        left = eval_(node.left)
-        right = eval_(node.right)
+def remember(key: str, ok: bool, result):
+    _cache[key] = (ok, result)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
 
-        if isinstance(node.op, ast.Pow):
-            if right > MAXPOW:
-                raise ValueError(f"Power {right} is too large")
 
-        val = operators[type(node.op)](eval_(node.left), eval_(node.right))
-        if abs(val) > MAXVAL:
-            raise ValueError(f"Value {val} is too large")
-        return val
-    elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
-        val = operators[type(node.op)](eval_(node.operand))
-        if abs(val) > MAXVAL:
-            raise ValueError(f"Value {val} is too large")
-        return val
-    else:
-        raise TypeError(f'{node} t = {type(node)}')
+def compile_expr(expr: str):
+    """Parse and evaluate a normalised expression, checking limits as it goes."""
+    if len(expr) > MAX_LENGTH:
+        raise ValueError(f"Expression is too long (max {MAX_LENGTH} characters)")
+    return Evaluator().eval(ast.parse(expr, mode='eval').body)
+
 
+def _bits(val) -> int:
+    return val.bit_length() if isinstance(val, int) else 0
 
-def limit(max_=None):
-    """Return decorator that limits allowed returned values."""
 
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            ret = func(*args, **kwargs)
-            try:
-                mag = abs(ret)
-            except TypeError:
-                pass  # not applicable
-            else:
-                if mag > max_:
-                    raise ValueError(ret)
-            return ret
+def _min_bits(node_op: ast.operator, left, right) -> int:
+    """Lower bound on the width of an integer result, so oversized work is refused before it starts."""
+    if not isinstance(left, int) or not isinstance(right, int):
+        return 0  # floats are fixed size; overflow raises on its own
+    if isinstance(node_op, ast.Pow) and right > 0 and abs(left) > 1:
+        return (_bits(left) - 1) * right + 1
+    if isinstance(node_op, ast.Mult) and left != 0 and right != 0:
+        return _bits(left) + _bits(right) - 1
+    return 0
 
-        return wrapper
 
-    return decorator
+class Evaluator:
+    """Evaluates each node once, within an operator budget."""
 
+    def __init__(self, max_ops: int = MAX_OPS):
+        self.ops_left = max_ops
+
+    def charge(self):
+        self.ops_left -= 1
+        if self.ops_left < 0:
+            raise ValueError(f"Expression is too complex (max {MAX_OPS} operators)")
+
+    @staticmethod
+    def check(val):
+        if abs(val) > MAXVAL:
+            raise ValueError(f"Value {val} is too large")
+        return val
 
-evil_ = limit(max_=10 ** 100)(eval_)
+    def eval(self, node):
+        if isinstance(node, ast.Constant):  # <number>
+            if type(node.value) not in (int, float, complex):
+                raise TypeError(f'{node.value!r} t = {type(node.value)}')
+            return self.check(node.value)
+        elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
+            fn = operators.get(type(node.op))
+            if fn is None:
+                raise TypeError(f'{node.op} t = {type(node.op)}')
+            self.charge()
+            left = self.eval(node.left)
+            right = self.eval(node.right)
+
+            if isinstance(node.op, ast.Pow):
+                if right > MAXPOW:
+                    raise ValueError(f"Power {right} is too large")
+            if _min_bits(node.op, left, right) > MAX_BITS:
+                raise ValueError(f"Value is too large (over {MAX_BITS} bits)")
+
+            return self.check(fn(left, right))
+        elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
+            fn = operators.get(type(node.op))
+            if fn is None:
+                raise TypeError(f'{node.op} t = {type(node.op)}')
+            self.charge()
+            return self.check(fn(self.eval(node.operand)))
+        else:
+            raise TypeError(f'{node} t = {type(node)}')
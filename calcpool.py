@@ -0,0 +1,192 @@
+# \calc runs in pre-forked worker processes, so a hostile expression costs a worker restart instead of the bot
+import asyncio
+import multiprocessing
+import os
+import resource
+import signal
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from typing import *
+
+import calc
+
+WORKERS = 2
+TIMEOUT = 2.0  # seconds of wall clock per expression
+MEMORY = 64 * 1024 * 1024  # bytes of address space a worker may grow by
+MAX_REQUESTS = 500  # expressions a worker handles before it's replaced
+
+# fork, not spawn: box.py does its work at import time, so it can't be re-imported in a child
+_context = multiprocessing.get_context('fork')
+
+
+def _address_space() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _worker(conn: Connection, memory: int):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        # the fork starts out with all of the parent's mappings, so the limit is relative to those
+        limit = _address_space() + memory
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (OSError, ValueError) as e:
+        print(f'calc worker {os.getpid()}: no memory limit ({e})')
+    while True:
+        try:
+            expr = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            outcome = (True, calc.compile_expr(expr))
+        except MemoryError:
+            outcome = (False, ValueError('ran out of memory'))
+        except Exception as e:
+            outcome = (False, e)
+        try:
+            conn.send(outcome)
+        except Exception as e:
+            conn.send((False, ValueError(f'{type(e).__name__}: {e}')))
+
+
+def _nursery(conn: Connection, memory: int):
+    """
+    Fork a worker for every request on conn, and send back its pid and the parent end of its pipe.
+    This process is forked before the bot starts any threads and never starts one, so a worker can't
+    inherit a lock that another thread was holding.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # dead workers are reaped by the kernel
+    while True:
+        try:
+            conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        parent, child = _context.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            parent.close()
+            try:
+                _worker(child, memory)
+            finally:
+                os._exit(0)
+        child.close()
+        conn.send(pid)
+        reduction.send_handle(conn, parent.fileno(), os.getppid())
+        parent.close()
+
+
+class Worker:
+    def __init__(self, conn: Connection, pid: int):
+        self.conn = conn
+        self.pid = pid
+        self.served = 0
+
+    def kill(self):
+        self.conn.close()
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class CalcPool:
+    def __init__(self, workers: int = WORKERS, timeout: float = TIMEOUT, memory: int = MEMORY,
+                 max_requests: int = MAX_REQUESTS):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory = memory
+        self.max_requests = max_requests
+        self.evaluated = 0
+        self.cache_hits = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.recycled = 0
+        self._idle: Optional[asyncio.Queue] = None
+        self._nursery: Optional[multiprocessing.Process] = None
+        self._nursery_conn: Optional[Connection] = None
+
+    def start(self):
+        """
+        Fork the process workers are forked from, and the first workers. Call this early, before the bot has
+        started its other threads; replacements come from the same process, so they're safe to fork later.
+        """
+        if self._idle is not None:
+            return
+        self._nursery_conn, child = _context.Pipe()
+        self._nursery = _context.Process(target=_nursery, args=(child, self.memory), daemon=True, name='calc')
+        self._nursery.start()
+        child.close()
+        self._idle = asyncio.Queue()
+        for _ in range(self.workers):
+            self._idle.put_nowait(self._fork())
+
+    def _fork(self) -> Worker:
+        self._nursery_conn.send(None)
+        pid = self._nursery_conn.recv()
+        return Worker(Connection(reduction.recv_handle(self._nursery_conn)), pid)
+
+    def stop(self):
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            self._idle.get_nowait().kill()
+        self._idle = None
+        self._nursery_conn.close()
+        self._nursery.join(1)
+        if self._nursery.is_alive():
+            self._nursery.kill()
+        self._nursery = self._nursery_conn = None
+
+    async def _request(self, worker: Worker, expr: str) -> Tuple[bool, Any]:
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = worker.conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            worker.conn.send(expr)
+            await asyncio.wait_for(ready, self.timeout)
+        finally:
+            loop.remove_reader(fd)
+        return worker.conn.recv()
+
+    async def evaluate(self, expr: str):
+        """Like calc.eval_expr, but in a worker. Raises ValueError if the worker runs out of time or memory."""
+        key = calc.normalise(expr)
+        outcome = calc.cached(key)
+        if outcome is not None:
+            self.cache_hits += 1
+        else:
+            if self._idle is None:
+                self.start()
+            worker = await self._idle.get()
+            healthy = False
+            try:
+                outcome = await self._request(worker, key)
+                healthy = True
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                outcome = (False, ValueError(f'took longer than {self.timeout:g}s'))
+            except (EOFError, OSError):
+                self.crashes += 1
+                outcome = (False, ValueError('ran out of memory'))
+            finally:
+                # a worker that was cancelled mid-request may still answer later; don't reuse it
+                worker.served += 1
+                if not healthy or worker.served >= self.max_requests:
+                    if healthy:
+                        self.recycled += 1
+                    worker.kill()
+                    worker = self._fork()
+                self._idle.put_nowait(worker)
+            self.evaluated += 1
+            calc.remember(key, *outcome)
+        ok, result = outcome
+        if ok:
+            return result
+        raise result.with_traceback(None)
+
+    def report(self) -> str:
+        return f"&a{self.evaluated} &7evaluated, &a{self.cache_hits} &7cached, &c{self.timeouts} &7timed out, " \
+               f"&c{self.crashes} &7crashed, &a{self.recycled} &7recycled\n"
@@ -1,9 +1,9 @@
-from spymap.based import player_init_tables, fixup_updates, with_player_cursor, with_player_connection
+from spymap.based import compact_updates, player_connector
 
 
 def main():
-    with_player_cursor(player_init_tables)()
-    with_player_cursor(fixup_updates)()
+    with player_connector() as conn:
+        compact_updates(conn)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+# Concurrent command dispatch: every command is its own task, with per-user and global limits
+import asyncio
+import time
+from typing import *
+
+CONCURRENCY = 8  # commands running at once
+BACKLOG = 32  # commands waiting for a slot; past this, new ones are turned away
+USER_RATE = 0.5  # commands per second per user, sustained
+USER_BURST = 4
+MAX_BUCKETS = 1024
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.warned = False
+
+    def refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return self.tokens
+
+    def take(self) -> bool:
+        if self.refill() >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Dispatcher:
+    def __init__(self,
+                 run: Callable[[Any, dict], Coroutine],
+                 reject: Callable[[Any, dict, str], Coroutine],
+                 concurrency: int = CONCURRENCY, backlog: int = BACKLOG,
+                 user_rate: float = USER_RATE, user_burst: float = USER_BURST):
+        """
+        run(sock, data) handles a command; reject(sock, data, reason) tells the user it was turned away.
+        """
+        self.run = run
+        self.reject = reject
+        self.concurrency = concurrency
+        self.backlog = backlog
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.in_flight = 0
+        self.shed = 0
+        self.limited = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _bucket(self, user: str) -> TokenBucket:
+        bucket = self.buckets.get(user)
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                # forget users whose buckets have refilled; they'd start full anyway
+                self.buckets = {k: v for k, v in self.buckets.items() if v.refill() < v.capacity}
+            bucket = self.buckets[user] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    def _spawn(self, coro: Coroutine):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            print(f'Command failed: {type(e)} {e}')
+
+    def dispatch(self, sock, data: dict) -> bool:
+        """Start handling a command in the background. Returns False if it was turned away."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        user = data['user']['uuid']
+        bucket = self._bucket(user)
+        if not bucket.take():
+            self.limited += 1
+            if not bucket.warned:  # once, not once per spammed command
+                bucket.warned = True
+                self._spawn(self.reject(sock, data, 'slow down; too many commands'))
+            return False
+        bucket.warned = False
+        if self.in_flight >= self.concurrency + self.backlog:
+            self.shed += 1
+            self._spawn(self.reject(sock, data, 'busy right now, try again in a moment'))
+            return False
+        self.in_flight += 1
+        self._spawn(self._run(sock, data))
+        return True
+
+    async def _run(self, sock, data: dict):
+        try:
+            async with self._semaphore:
+                await self.run(sock, data)
+        finally:
+            self.in_flight -= 1
@@ -7,6 +7,8 @@ import time
 
 import requests
 
+from metrics import METRICS
+
 TRANSFER_TO = "kpk8qmvoy7"
 with open("krist_key.txt") as f:
     PRIVATE = f.read().strip()
@@ -29,15 +31,16 @@ def send_to(address: str, amount: int, meta: str = '') -> None:
     """
     Send krist to an address.
     """
-    resp = requests.post(
-        "https://krist.dev/transactions",
-        data={
-            "privatekey": PRIVATE,
-            "to": address,
-            "amount": amount,
-            "metadata": meta
-        },
-    )
+    with METRICS.timer('http', endpoint='krist'):
+        resp = requests.post(
+            "https://krist.dev/transactions",
+            data={
+                "privatekey": PRIVATE,
+                "to": address,
+                "amount": amount,
+                "metadata": meta
+            },
+        )
     return resp.json()['ok']
 
 
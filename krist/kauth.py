@@ -9,6 +9,7 @@ from typing import *
 import requests
 
 from krist.k import send_to
+from metrics import METRICS
 
 NAMES_TRUSTED = {
     "switchcraft": "kqxhx5yn9v"
@@ -116,7 +117,8 @@ def process(txn: dict):
 
 def prepare_done():
     global last_done
-    resp = requests.get(f'https://krist.dev/lookup/transactions/{ADDR}?order=DESC&limit=500')
+    with METRICS.timer('http', endpoint='krist'):
+        resp = requests.get(f'https://krist.dev/lookup/transactions/{ADDR}?order=DESC&limit=500')
     txns = resp.json()['transactions']
     incoming: Set[int] = set()
     outgoing: Set[int] = set()
@@ -149,7 +151,8 @@ prepare_done()
 
 def read_incoming():
     global last_done
-    resp = requests.get(f'https://krist.dev/lookup/transactions/{ADDR}?order=DESC&limit=500')
+    with METRICS.timer('http', endpoint='krist'):
+        resp = requests.get(f'https://krist.dev/lookup/transactions/{ADDR}?order=DESC&limit=500')
     txns = resp.json()['transactions']
     txn_cache = {}
     incoming: Set[int] = set()
@@ -1,10 +1,12 @@
 # Convert Minecraft formatting codes (&a, etc) to rich formmatted text
 
+import functools
+import re
+from typing import *
+
 from rich import print as rp
 from rich.markup import escape
 
-from spymap import based
-
 CODES = {
     '0': '[rgb(0,0,0)]',
     '1': '[rgb(0,0,170)]',
@@ -32,12 +34,92 @@ CODES = {
 }
 
 
+ANSI_COLORS = {
+    '0': (0, 0, 0), '1': (0, 0, 170), '2': (0, 170, 0), '3': (0, 170, 170),
+    '4': (170, 0, 0), '5': (170, 0, 170), '6': (255, 170, 0), '7': (170, 170, 170),
+    '8': (85, 85, 85), '9': (85, 85, 255), 'a': (85, 255, 85), 'b': (85, 255, 255),
+    'c': (255, 85, 85), 'd': (255, 85, 255), 'e': (255, 255, 85), 'f': (255, 255, 255),
+}
+ANSI_CODES = {
+    # a colour code also clears formatting, like it does in game
+    **{code: f'\x1b[0;38;2;{r};{g};{b}m' for code, (r, g, b) in ANSI_COLORS.items()},
+    'k': '\x1b[5m',
+    'l': '\x1b[1m',
+    'm': '\x1b[9m',
+    'n': '\x1b[4m',
+    'o': '\x1b[3m',
+    'r': '\x1b[0m',
+}
+ANSI_RESET = '\x1b[0m'
+
+RICH = 'rich'
+ANSI = 'ansi'
+PLAIN = 'plain'
+
+# '&&' is a literal '&'; '&' followed by anything that isn't a code is left alone
+TOKEN_RE = re.compile(r'&([0-9a-fk-or&])', re.IGNORECASE)
+CACHE_SIZE = 512
+
+Token = Tuple[Optional[str], str]  # (code, text); code is None for plain text, text is '' for a code
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def tokenize(text: str) -> Tuple[Token, ...]:
+    """Split text into runs of plain text and formatting codes, in one pass."""
+    parts = TOKEN_RE.split(text)  # text, code, text, code, ..., text
+    tokens: List[Token] = []
+    run = parts[0]
+    for i in range(1, len(parts), 2):
+        code = parts[i].lower()
+        if code == '&':
+            run += '&' + parts[i + 1]
+            continue
+        if run:
+            tokens.append((None, run))
+        tokens.append((code, ''))
+        run = parts[i + 1]
+    if run:
+        tokens.append((None, run))
+    return tuple(tokens)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def render(text: str, style: str = RICH) -> str:
+    """Render formatting codes as rich markup, ANSI escapes, or nothing at all (PLAIN)."""
+    output = []
+    formatted = False
+    for code, run in tokenize(text):
+        if code is None:
+            # escape() only changes '[' and a trailing backslash, and it's slow enough to be worth skipping
+            if style == RICH and ('[' in run or run.endswith('\\')):
+                run = escape(run)
+            output.append(run)
+        elif style == RICH:
+            output.append(CODES[code])
+        elif style == ANSI:
+            output.append(ANSI_CODES[code])
+            formatted = True
+    if formatted:
+        output.append(ANSI_RESET)
+    return ''.join(output)
+
+
+def visible_length(text: str) -> int:
+    """Length of text as the player sees it, without formatting codes"""
+    return sum(len(run) for _, run in tokenize(text))
+
+
 def mc2rich(text: str) -> str:
     """Convert Minecraft formatting codes (&a, etc) to rich formmatted text"""
-    text = escape(text)
-    for code, rich in CODES.items():
-        text = text.replace('&' + code, rich)
-    return text
+    return render(text, RICH)
+
+
+def mc2ansi(text: str) -> str:
+    return render(text, ANSI)
+
+
+def mc2plain(text: str) -> str:
+    return render(text, PLAIN)
 
 
 if __name__ == '__main__':
@@ -56,5 +138,8 @@ if __name__ == '__main__':
 &rr &rMinecraft"""
     rp(mc2rich(testbench))
 
+    print(mc2ansi(testbench))
+
+    from spymap import based
     # print(based.dbhealth_report())
     rp(mc2rich(based.player_report("PenguinEncounter")))
@@ -0,0 +1,161 @@
+# Counters and latency histograms, readable in \dbhealth or (opt-in) as Prometheus text over HTTP
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import *
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = '') -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # not cumulative; added up on export
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count > 0 else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile"""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry:
+    def __init__(self):
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.lock = threading.Lock()  # the p.db writer and krist threads record too
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = _labels(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Time the block into <name>_seconds; count exceptions that escape it in <name>_errors_total.
+        Cancellation and interrupts aren't errors.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f'{name}_errors_total', **labels)
+            raise
+        finally:
+            self.observe(f'{name}_seconds', time.perf_counter() - start, **labels)
+
+    def exposition(self) -> str:
+        """Everything, in Prometheus text format"""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in series.items():
+                    lines.append(f'{name}{_format_labels(labels)} {value:g}')
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for labels, hist in series.items():
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        le = _format_labels(labels, f'le="{bound:g}"')
+                        lines.append(f'{name}_bucket{le} {cumulative}')
+                    le = _format_labels(labels, 'le="+Inf"')
+                    lines.append(f'{name}_bucket{le} {hist.count}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {hist.sum:g}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, limit: int = None) -> str:
+        """One line per timed thing, for chat; only the limit that took the most time in total, if given"""
+        output = "&8-&f\n"
+        with self.lock:
+            rows = [
+                (name, labels, hist)
+                for name, series in self.histograms.items()
+                for labels, hist in series.items()
+            ]
+            rows.sort(key=lambda row: -row[2].sum)
+            shown = rows if limit is None else rows[:limit]
+            for name, labels, hist in sorted(shown, key=lambda row: row[:2]):
+                short = name[:-len('_seconds')] if name.endswith('_seconds') else name
+                errors = self.counters.get(f'{short}_errors_total', {})
+                label = ' '.join([short] + [v for _, v in labels])
+                output += f"&a{label} &7x{hist.count}"
+                if errors.get(labels, 0) > 0:
+                    output += f" (&c{errors[labels]:g} &7failed)"
+                output += f"&7: mean &a{hist.mean * 1000:.0f}ms&7, p95 &a{hist.quantile(0.95) * 1000:.0f}ms" \
+                          f"&7, max &a{hist.max * 1000:.0f}ms\n"
+            if len(shown) < len(rows):
+                output += f"&8...and {len(rows) - len(shown)} more\n"
+        return output
+
+    async def serve(self, port: int, host: str = '127.0.0.1') -> asyncio.AbstractServer:
+        """Answer any HTTP request on host:port with exposition()."""
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                # request line and headers; nothing in them changes the answer
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                body = self.exposition().encode()
+                writer.write(b'HTTP/1.1 200 OK\r\n'
+                             b'Content-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                             b'Connection: close\r\n\r\n' + body)
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        print(f'Metrics on http://{host}:{port}/metrics')
+        return server
+
+
+METRICS = Registry()
@@ -0,0 +1,164 @@
+# Outbound chatbox messages: one queue, paced to the chatbox's rate limit
+import asyncio
+import json
+import time
+from collections import deque
+from typing import *
+
+from websockets.client import WebSocketClientProtocol
+
+from mc2rich import visible_length
+
+RATE = 4  # packets per second, sustained
+BURST = 6
+MAX_DEPTH = 256  # queued packets; past this new tells are dropped
+MAX_TELL_LENGTH = 1024  # longer tells are split between lines; merged tells stay under this
+RATE_LIMITED_PAUSE = 2  # seconds to hold off after the server says we're going too fast
+
+
+class Packet:
+    def __init__(self, user: str, name: str, text: str, mode: str):
+        self.user = user
+        self.name = name
+        self.text = text
+        self.mode = mode
+        self.queued_at = time.monotonic()
+        self.payload = self.serialise()
+
+    def serialise(self) -> str:
+        return json.dumps({
+            'type': 'tell',
+            'user': self.user,
+            'name': self.name,
+            'text': self.text,
+            'mode': self.mode
+        })
+
+    def merge(self, text: str) -> bool:
+        if len(self.text) + 1 + len(text) > MAX_TELL_LENGTH:
+            return False
+        self.text += '\n' + text
+        self.payload = self.serialise()
+        return True
+
+
+def split_lines(text: str, limit: int = MAX_TELL_LENGTH) -> List[str]:
+    """Break text between lines into pieces that each show at most limit characters (a longer line stays whole)."""
+    if len(text) <= limit:
+        return [text]  # formatting codes only ever add to len
+    pieces, piece, length = [], [], 0
+    for line in text.split('\n'):
+        line_length = visible_length(line)
+        if len(piece) > 0 and length + 1 + line_length > limit:
+            pieces.append('\n'.join(piece))
+            piece, length = [], 0
+        length += line_length + (1 if len(piece) > 0 else 0)
+        piece.append(line)
+    pieces.append('\n'.join(piece))
+    return pieces
+
+
+class Outbox:
+    def __init__(self, rate: float = RATE, burst: int = BURST, max_depth: int = MAX_DEPTH):
+        self.rate = rate
+        self.burst = burst
+        self.max_depth = max_depth
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self.queue: Deque[Packet] = deque()
+        self.open: Dict[Tuple[str, str, str], Packet] = {}  # queued tells that can still take more text
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.sent if self.sent > 0 else 0.0
+
+    def tell(self, user: str, name: str, text: str, mode: str = 'format'):
+        """
+        Queue a tell. Consecutive tells to the same user from the same command are merged while they wait.
+        Text longer than MAX_TELL_LENGTH goes out as several tells.
+        """
+        pieces = split_lines(text)
+        if len(pieces) > 1:
+            for piece in pieces:
+                self.tell(user, name, piece, mode)
+            return
+        key = (user, name, mode)
+        pending = self.open.get(key)
+        if pending is not None and pending.merge(text):
+            self.merged += 1
+            return
+        if len(self.queue) >= self.max_depth:
+            self.dropped += 1
+            print(f'Outbox full, dropping tell to {user}')
+            return
+        packet = Packet(user, name, text, mode)
+        self.queue.append(packet)
+        self.open[key] = packet
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def backoff(self):
+        """The server told us we're sending too fast."""
+        self.tokens = 0
+        self.paused_until = time.monotonic() + RATE_LIMITED_PAUSE
+
+    async def _take(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def run(self, sock: WebSocketClientProtocol):
+        """Send queued packets over sock until cancelled."""
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                if len(self.queue) == 0:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                await self._take()
+                packet = self.queue.popleft()
+                key = (packet.user, packet.name, packet.mode)
+                if self.open.get(key) is packet:
+                    del self.open[key]
+                try:
+                    await sock.send(packet.payload)
+                except Exception as e:
+                    self.failed += 1
+                    print(f'Failed to send tell to {packet.user}: {type(e)} {e}')
+                    if sock.closed:
+                        raise
+                    continue
+                latency = time.monotonic() - packet.queued_at
+                self.sent += 1
+                self.last_latency = latency
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+        finally:
+            self._wakeup = None
+
+    def report(self) -> str:
+        return f"&a{self.depth} &7queued, &a{self.sent} &7sent (&a{self.merged} &7merged, &c{self.dropped} &7dropped, " \
+               f"&c{self.failed} &7failed)\n    &7latency last &a{self.last_latency * 1000:.0f}ms&7, " \
+               f"mean &a{self.mean_latency * 1000:.0f}ms&7, max &a{self.max_latency * 1000:.0f}ms\n"
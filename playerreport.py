@@ -1,11 +1,21 @@
+import asyncio
 import sys
 
-from spymap.based import player_init_tables, with_player_cursor, player_report
+from rich import print as rich_print
+
+from mc2rich import mc2rich
+from spymap.based import player_init_tables, with_player_cursor, player_report_async
+from spymap.tools import close_session
+
+
+async def report(name: str):
+    rich_print(mc2rich(await player_report_async(name)))
+    await close_session()
 
 
 def main():
     with_player_cursor(player_init_tables)()
-    player_report(sys.argv[1])
+    asyncio.run(report(sys.argv[1]))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+# Background jobs: every job is its own asyncio task with its own interval
+import asyncio
+import random
+import time
+from typing import *
+
+from metrics import METRICS
+
+SKIP = 'skip'  # a run that comes due while the previous one is still going is dropped
+COALESCE = 'coalesce'  # ...or folded into one extra run right after it finishes
+
+
+class JobStats:
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0
+        self.last_start = 0.0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+
+    @property
+    def mean_duration(self) -> float:
+        return self.total_duration / self.runs if self.runs > 0 else 0.0
+
+    def record(self, duration: float, ok: bool):
+        self.runs += 1
+        self.failures += 0 if ok else 1
+        self.last_duration = duration
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+
+
+class Job:
+    def __init__(self, fn: Callable[..., Coroutine], interval: float, jitter: float = 0.0, overrun: str = SKIP,
+                 name: str = None):
+        assert interval > 0, 'interval must be positive'
+        assert overrun in (SKIP, COALESCE), f'unknown overrun policy {overrun}'
+        self.fn = fn
+        self.interval = interval
+        self.jitter = jitter
+        self.overrun = overrun
+        self.name = name if name is not None else fn.__name__
+        self.stats = JobStats()
+        self._running: Optional[asyncio.Task] = None
+        self._again = False
+
+    async def _invoke(self, args: tuple):
+        while True:
+            self._again = False
+            start = time.perf_counter()
+            self.stats.last_start = time.time()
+            ok = True
+            try:
+                await self.fn(*args)
+            except Exception as e:
+                ok = False
+                print(f'Job {self.name} failed: {type(e)} {e}')
+            duration = time.perf_counter() - start
+            self.stats.record(duration, ok)
+            METRICS.observe('job_seconds', duration, job=self.name)
+            if not ok:
+                METRICS.inc('job_errors_total', job=self.name)
+            if not self._again:
+                break
+
+    async def run_forever(self, *args):
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        try:
+            while True:
+                delay = due - loop.time() + random.uniform(0, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # fixed rate; if we fell behind, don't try to make up for it
+                due += self.interval
+                now = loop.time()
+                if due < now:
+                    due = now + self.interval
+                if self._running is not None and not self._running.done():
+                    self.stats.overruns += 1
+                    if self.overrun == COALESCE:
+                        self._again = True
+                    continue
+                self._running = asyncio.create_task(self._invoke(args))
+        finally:
+            if self._running is not None:
+                self._running.cancel()
+                self._running = None
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs: List[Job] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def add(self, fn: Callable[..., Coroutine], interval: float, jitter: float = 0.0, overrun: str = SKIP) -> Job:
+        job = Job(fn, interval, jitter, overrun)
+        self.jobs.append(job)
+        return job
+
+    def start(self, *args):
+        """Start every job, passing args to each run."""
+        self.stop()
+        self._tasks = [asyncio.create_task(job.run_forever(*args)) for job in self.jobs]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def report(self) -> str:
+        output = "&8-&f\n"
+        for job in self.jobs:
+            stats = job.stats
+            output += f"&a{job.name} &7every {job.interval:g}s: &a{stats.runs} &7runs"
+            if stats.failures > 0:
+                output += f", &c{stats.failures} &7failed"
+            if stats.overruns > 0:
+                output += f", &e{stats.overruns} &7overruns"
+            output += f"\n    &7last &a{stats.last_duration * 1000:.0f}ms&7, mean &a{stats.mean_duration * 1000:.0f}ms" \
+                      f"&7, max &a{stats.max_duration * 1000:.0f}ms\n"
+        return output
@@ -1,126 +1,435 @@
+import asyncio
+import atexit
 import random
 import time
-from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import Future
 from sqlite3 import connect, Connection, Cursor
-from typing import Optional
+from typing import *
 
-import requests
 from rich import print as rich_print
 
-from spymap import integration
-from spymap.structures import DynmapPlayerListing, DynmapConfiguration, DynmapPlayer
+from spymap import integration, retention
+from spymap.db import PlayerDatabase, DB_PATH, configure
+from spymap.reports import ReportCache, Position
+from spymap.resolver import NameResolver
+from spymap.simplify import TrailSimplifier
+from spymap.structures import DynmapPlayerListing, DynmapConfiguration, PlayerFrame, WORLDS
 from mc2rich import mc2rich
+from metrics import METRICS
 
 
 def player_connector() -> Connection:
-    return connect('p.db')
+    return configure(connect(DB_PATH))
 
 
+NOW = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+# Current schema. Timestamps are integer unix times (UTC).
 CREATE = {
+    "LatestPosition": f"CREATE TABLE IF NOT EXISTS LatestPosition (uuid TEXT PRIMARY KEY, username TEXT COLLATE NOCASE, timestamp INTEGER NOT NULL DEFAULT {NOW}, x REAL, y REAL, z REAL, world TEXT)",
+    "Updates": f"CREATE TABLE IF NOT EXISTS Updates (ord INTEGER PRIMARY KEY, uuid TEXT, username TEXT COLLATE NOCASE, timestamp INTEGER NOT NULL DEFAULT {NOW}, x REAL, y REAL, z REAL, world TEXT)",
+    "NameUUID": f"CREATE TABLE IF NOT EXISTS NameUUID (uuid TEXT PRIMARY KEY, username TEXT COLLATE NOCASE, last_refresh INTEGER NOT NULL DEFAULT {NOW})",
+    # progress of resumable maintenance jobs
+    "Maintenance": "CREATE TABLE IF NOT EXISTS Maintenance (job TEXT PRIMARY KEY, cursor INTEGER NOT NULL)",
+    # Updates rows moved out to compressed files by spymap.retention
+    "ArchiveSegments": "CREATE TABLE IF NOT EXISTS ArchiveSegments (path TEXT PRIMARY KEY, start INTEGER NOT NULL, stop INTEGER NOT NULL, rows INTEGER NOT NULL)",
+    # row counts, kept up to date by triggers so dbhealth doesn't have to count
+    "Stats": "CREATE TABLE IF NOT EXISTS Stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+}
+
+INDEXES = {
+    "UpdatesByPlayer": "CREATE INDEX IF NOT EXISTS UpdatesByPlayer ON Updates (uuid, ord)",
+    "UpdatesByTime": "CREATE INDEX IF NOT EXISTS UpdatesByTime ON Updates (timestamp)",
+    # covers lookup_uuid
+    "NameUUIDByName": "CREATE INDEX IF NOT EXISTS NameUUIDByName ON NameUUID (username, uuid, last_refresh)",
+}
+
+
+def int_floor(column: str) -> str:
+    return f"(CAST({column} AS INTEGER) - ({column} < CAST({column} AS INTEGER)))"
+
+
+def int_ceil(column: str) -> str:
+    return f"(CAST({column} AS INTEGER) + ({column} > CAST({column} AS INTEGER)))"
+
+
+# UpdatesRTree times are seconds since this, so they fit rtree_i32 until 2092 instead of January 2038
+RTREE_EPOCH = 1_700_000_000
+
+
+def rtree_row(prefix: str) -> str:
+    """Values for an UpdatesRTree row from an Updates row (NEW, OLD or a table alias)"""
+    x, z, t = f"{prefix}.x", f"{prefix}.z", f"{prefix}.timestamp - {RTREE_EPOCH}"
+    return f"{prefix}.ord, {int_floor(x)}, {int_ceil(x)}, {int_floor(z)}, {int_ceil(z)}, {t}, {t}"
+
+
+# (x, z, time) index over Updates for "who was here" queries, kept in step by triggers
+RTREE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS UpdatesRTree USING rtree_i32(ord, x1, x2, z1, z2, t1, t2)",
+    f"CREATE TRIGGER IF NOT EXISTS UpdatesRTreeInsert AFTER INSERT ON Updates BEGIN "
+    f"INSERT INTO UpdatesRTree VALUES ({rtree_row('NEW')}); END",
+    "CREATE TRIGGER IF NOT EXISTS UpdatesRTreeDelete AFTER DELETE ON Updates BEGIN "
+    "DELETE FROM UpdatesRTree WHERE ord = OLD.ord; END",
+    # compact_updates renumbers ord
+    f"CREATE TRIGGER IF NOT EXISTS UpdatesRTreeUpdate AFTER UPDATE OF ord, x, z, timestamp ON Updates BEGIN "
+    f"DELETE FROM UpdatesRTree WHERE ord = OLD.ord; INSERT INTO UpdatesRTree VALUES ({rtree_row('NEW')}); END",
+]
+
+
+def row_counter(table: str) -> List[str]:
+    """
+    Keep Stats[table] equal to COUNT(*) of table.
+    Only real inserts and deletes are counted: INSERT OR REPLACE deletes without firing the delete trigger,
+    so writers to counted tables use UPSERT instead.
+    """
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}CountInsert AFTER INSERT ON {table} BEGIN "
+        f"UPDATE Stats SET value = value + 1 WHERE name = '{table}'; END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}CountDelete AFTER DELETE ON {table} BEGIN "
+        f"UPDATE Stats SET value = value - 1 WHERE name = '{table}'; END",
+        f"INSERT OR REPLACE INTO Stats (name, value) SELECT '{table}', COUNT(*) FROM {table}",
+    ]
+
+
+# Schema before versioning (user_version 0): TEXT timestamps, no indexes
+LEGACY_CREATE = {
     "LatestPosition": "CREATE TABLE IF NOT EXISTS LatestPosition (uuid TEXT PRIMARY KEY, username TEXT, timestamp TEXT DEFAULT CURRENT_TIMESTAMP, x REAL, y REAL, z REAL, world TEXT)",
     "Updates": "CREATE TABLE IF NOT EXISTS Updates (ord INTEGER PRIMARY KEY, uuid TEXT, username TEXT, timestamp TEXT DEFAULT CURRENT_TIMESTAMP, x REAL, y REAL, z REAL, world TEXT)",
     "NameUUID": "CREATE TABLE IF NOT EXISTS NameUUID (uuid TEXT PRIMARY KEY, username TEXT, last_refresh TEXT DEFAULT CURRENT_TIMESTAMP)"
 }
 
-ADDITIONAL_CREATE = {
-    "fixup": CREATE["Updates"].replace("Updates", "fixup")
-}
+
+def rebuild_table(table: str, create: str, select: str) -> List[str]:
+    """Steps to recreate table with the CREATE statement create, copying rows over with select."""
+    return [
+        f"DROP TABLE IF EXISTS {table}_new",
+        create.replace(f" {table} (", f" {table}_new (", 1),
+        f"INSERT INTO {table}_new SELECT {select} FROM {table}",
+        f"DROP TABLE {table}",
+        f"ALTER TABLE {table}_new RENAME TO {table}",
+    ]
+
+
+def epoch_of(column: str) -> str:
+    return f"COALESCE(CAST(strftime('%s', {column}) AS INTEGER), 0)"
+
+
+# an UpdatesRTree row as it was at version 6, with raw unix times
+V6_RTREE_ROW = (
+    "{p}.ord, (CAST({p}.x AS INTEGER) - ({p}.x < CAST({p}.x AS INTEGER))), "
+    "(CAST({p}.x AS INTEGER) + ({p}.x > CAST({p}.x AS INTEGER))), "
+    "(CAST({p}.z AS INTEGER) - ({p}.z < CAST({p}.z AS INTEGER))), "
+    "(CAST({p}.z AS INTEGER) + ({p}.z > CAST({p}.z AS INTEGER))), {p}.timestamp, {p}.timestamp"
+)
+
+# MIGRATIONS[n] takes the schema from user_version n to n + 1
+MIGRATIONS: List[List[str]] = [
+    list(LEGACY_CREATE.values()),
+    # integer timestamps, case-insensitive usernames; the tables as they were at version 2, not CREATE
+    rebuild_table(
+        "LatestPosition",
+        "CREATE TABLE IF NOT EXISTS LatestPosition (uuid TEXT PRIMARY KEY, username TEXT COLLATE NOCASE, "
+        "timestamp INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)), x REAL, y REAL, z REAL, world TEXT)",
+        f"uuid, username, {epoch_of('timestamp')}, x, y, z, world"
+    )
+    + rebuild_table(
+        "Updates",
+        "CREATE TABLE IF NOT EXISTS Updates (ord INTEGER PRIMARY KEY, uuid TEXT, username TEXT COLLATE NOCASE, "
+        "timestamp INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)), x REAL, y REAL, z REAL, world TEXT)",
+        f"ord, uuid, username, {epoch_of('timestamp')}, x, y, z, world"
+    )
+    + rebuild_table(
+        "NameUUID",
+        "CREATE TABLE IF NOT EXISTS NameUUID (uuid TEXT PRIMARY KEY, username TEXT COLLATE NOCASE, "
+        "last_refresh INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)))",
+        f"uuid, username, {epoch_of('last_refresh')}"
+    ),
+    list(INDEXES.values()),
+    [CREATE["Maintenance"]],
+    [CREATE["ArchiveSegments"], "CREATE INDEX IF NOT EXISTS ArchiveSegmentsByTime ON ArchiveSegments (start, stop)"],
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS UpdatesRTree USING rtree_i32(ord, x1, x2, z1, z2, t1, t2)",
+        "CREATE TRIGGER IF NOT EXISTS UpdatesRTreeInsert AFTER INSERT ON Updates BEGIN "
+        f"INSERT INTO UpdatesRTree VALUES ({V6_RTREE_ROW.format(p='NEW')}); END",
+        "CREATE TRIGGER IF NOT EXISTS UpdatesRTreeDelete AFTER DELETE ON Updates BEGIN "
+        "DELETE FROM UpdatesRTree WHERE ord = OLD.ord; END",
+        "CREATE TRIGGER IF NOT EXISTS UpdatesRTreeUpdate AFTER UPDATE OF ord, x, z, timestamp ON Updates BEGIN "
+        f"DELETE FROM UpdatesRTree WHERE ord = OLD.ord; INSERT INTO UpdatesRTree VALUES ({V6_RTREE_ROW.format(p='NEW')}); END",
+        f"INSERT INTO UpdatesRTree SELECT {V6_RTREE_ROW.format(p='Updates')} FROM Updates",
+    ],
+    [CREATE["Stats"], "CREATE INDEX IF NOT EXISTS NameUUIDByRefresh ON NameUUID (last_refresh)"]
+    + row_counter("LatestPosition") + row_counter("Updates") + row_counter("NameUUID"),
+    # UpdatesRTree times relative to RTREE_EPOCH
+    [
+        "DROP TRIGGER IF EXISTS UpdatesRTreeInsert",
+        "DROP TRIGGER IF EXISTS UpdatesRTreeDelete",
+        "DROP TRIGGER IF EXISTS UpdatesRTreeUpdate",
+        "DROP TABLE IF EXISTS UpdatesRTree",
+    ] + RTREE + [f"INSERT INTO UpdatesRTree SELECT {rtree_row('Updates')} FROM Updates"],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
 
 OUTDATED_NAME_TIME = 60 * 60 * 24
-TSTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def schema_version(cur: Cursor) -> int:
+    return cur.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(cur: Cursor):
+    """Bring the schema up to SCHEMA_VERSION, one committed transaction per version."""
+    conn = cur.connection
+    version = schema_version(cur)
+    while version < SCHEMA_VERSION:
+        start = time.time()
+        if not conn.in_transaction:
+            cur.execute("BEGIN")
+        try:
+            for sql in MIGRATIONS[version]:
+                cur.execute(sql)
+            version += 1
+            cur.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Migrated p.db to schema version {version} in {time.time() - start:.2f} seconds")
 
 
 def player_init_tables(cur: Cursor):
-    for table, sql in CREATE.items():
-        cur.execute(sql)
+    if schema_version(cur) < SCHEMA_VERSION:
+        migrate(cur)
+
+
+_database: Optional[PlayerDatabase] = None
 
 
-def fixup_updates(cur: Cursor):
+def get_database() -> PlayerDatabase:
+    """The process-wide p.db writer; tables are created once when it starts."""
+    global _database
+    if _database is None:
+        _database = PlayerDatabase(DB_PATH, init=player_init_tables)
+        _database.start()
+        atexit.register(_database.close)
+    return _database
+
+
+COMPACT_CHUNK = 10_000
+
+# next chunk of not-yet-compacted rows, numbered from where the last chunk stopped
+COMPACT_SELECT = (
+    "INSERT INTO temp.CompactMap (old, new) "
+    "SELECT ord, :done + ROW_NUMBER() OVER (ORDER BY ord) FROM (SELECT ord FROM Updates WHERE ord > :done ORDER BY ord LIMIT :chunk)"
+)
+COMPACT_STEPS = (
+    "DELETE FROM temp.CompactMap WHERE old = new",
+    # go through negative ords so the renumbering never collides with rows that haven't moved yet
+    "UPDATE Updates SET ord = -(SELECT new FROM temp.CompactMap WHERE old = Updates.ord) WHERE ord IN (SELECT old FROM temp.CompactMap)",
+    "UPDATE Updates SET ord = -ord WHERE ord < 0",
+)
+
+
+def compact_updates(conn: Connection, chunk: int = COMPACT_CHUNK):
+    """
+    Renumber Updates.ord to 1..N (keeping the order), in place.
+    Every chunk is its own short transaction and records its progress in Maintenance, so the tracker can keep
+    writing in between, and an interrupted run resumes where it stopped. Rows the tracker appends while this
+    runs are picked up by later chunks.
+    """
     start = time.time()
-    print("Reorganizing Updates table...")
-    cur.execute("DROP TABLE IF EXISTS fixup")
-    cur.execute(ADDITIONAL_CREATE["fixup"])
-    counter = 0
-    for row in cur.execute("SELECT uuid, username, x, y, z, world FROM Updates ORDER BY ord ASC").fetchall():
-        if counter % 100 == 0:
-            print(f"\rFixup: Processed {counter} rows...".ljust(50), end='', flush=True)
-        cur.execute("INSERT INTO fixup (ord, uuid, username, x, y, z, world) VALUES (?, ?, ?, ?, ?, ?, ?)", (counter, ) + row)
-        counter += 1
-    print(f"\rFixup: Processed {counter} rows.".ljust(50), flush=True)
-    cur.execute("DROP TABLE IF EXISTS Updates")
-    cur.execute("ALTER TABLE fixup RENAME TO Updates")
-    cur.execute("DROP TABLE IF EXISTS fixup")
-    stop = time.time()
-    print(f"Fixup took {stop - start:.2f} seconds")
-
-
-def get_uuid(cur: Cursor, username: str) -> Optional[str]:
-    uuid = cur.execute("SELECT uuid, last_refresh FROM NameUUID WHERE username LIKE ?", (username,)).fetchone()
-    if uuid is not None:
-        exp = datetime.strptime(uuid[1], TSTAMP_FORMAT)
-        if (datetime.now() - exp).total_seconds() < OUTDATED_NAME_TIME:
-            return uuid[0]
-    resp = requests.get(f"https://api.mojang.com/users/profiles/minecraft/{username}")
-    if resp.status_code == 200:
-        uuid = resp.json()['id']
-        cur.execute("DELETE FROM NameUUID WHERE username LIKE ?", (username,))
-        cur.execute("INSERT OR REPLACE INTO NameUUID (uuid, username) VALUES (?, ?)", (uuid, username))
-    elif resp.status_code == 404:
-        if uuid is not None:
-            return uuid[0]
-        return None
-    else:
-        return None
-    return uuid
+    cur = conn.cursor()
+    player_init_tables(cur)
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS CompactMap (old INTEGER PRIMARY KEY, new INTEGER NOT NULL)")
+    conn.commit()
+    row = cur.execute("SELECT cursor FROM Maintenance WHERE job = 'compact'").fetchone()
+    done = row[0] if row is not None else 0
+    if done > 0:
+        print(f"Compaction: resuming after {done} rows")
+    while True:
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("DELETE FROM temp.CompactMap")
+            moved = cur.execute(COMPACT_SELECT, {'done': done, 'chunk': chunk}).rowcount
+            for sql in COMPACT_STEPS:
+                cur.execute(sql)
+            done += moved
+            cur.execute("INSERT OR REPLACE INTO Maintenance (job, cursor) VALUES ('compact', ?)", (done,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"\rCompaction: {done} rows compacted...".ljust(50), end='', flush=True)
+        if moved == 0:
+            break
+    cur.execute("DELETE FROM Maintenance WHERE job = 'compact'")
+    conn.commit()
+    cur.close()
+    print(f"\rCompaction: {done} rows compacted.".ljust(50), flush=True)
+    print(f"Compaction took {time.time() - start:.2f} seconds")
 
 
-last_fix = time.time()
+def lookup_uuid(cur: Cursor, username: str) -> Tuple[Optional[str], bool]:
+    """Cached uuid for username, and whether the cache entry is still fresh."""
+    uuid = cur.execute("SELECT uuid, last_refresh FROM NameUUID WHERE username = ?", (username,)).fetchone()
+    if uuid is None:
+        return None, False
+    return uuid[0], time.time() - uuid[1] < OUTDATED_NAME_TIME
+
+
+def remember_uuids(cur: Cursor, found: List[Tuple[str, str]]):
+    now = int(time.time())
+    cur.executemany("DELETE FROM NameUUID WHERE username = ?", [(username,) for _, username in found])
+    cur.executemany(
+        "INSERT INTO NameUUID (uuid, username, last_refresh) VALUES (?, ?, ?) "
+        "ON CONFLICT (uuid) DO UPDATE SET username = excluded.username, last_refresh = excluded.last_refresh",
+        [(uuid, username, now) for uuid, username in found]
+    )
+
 
+RESOLVER = NameResolver(lookup_uuid, store=lambda found: get_database().submit(remember_uuids, found))
 
-def apply_update(cur: Cursor, conf: DynmapConfiguration, update_data: DynmapPlayerListing):
-    global last_fix
-    # prepare to update
-    next_ord = cur.execute("SELECT MAX(ord) FROM Updates").fetchone()[0]
-    next_ord = next_ord if next_ord is not None else 0
-    for player in update_data.players:
-        player: DynmapPlayer
-        if player.account is None:
-            continue
-        if player.world not in map(lambda x: x.internal, conf.worlds):
+
+last_fix = time.time()
+
+# Seen-only refreshes (player online but not moving) are written at most this often
+SEEN_FLUSH_INTERVAL = 10
+
+# Mirror of LatestPosition (uuid -> (x, y, z, world)), seeded on the first update.
+# Only touched from the writer thread.
+last_positions: Optional[Dict[str, Tuple[float, float, float, str]]] = None
+# uuid -> unix time the player was last seen online; may be ahead of LatestPosition.timestamp
+last_seen: Dict[str, float] = {}
+unflushed_seen: Set[str] = set()
+last_seen_flush = 0.0
+# The last frame apply_update wrote, and the uuid it resolved for each account id in it
+last_frame: Optional[PlayerFrame] = None
+frame_uuids: Dict[int, str] = {}
+# Decides which positions are worth a row in Updates; LatestPosition always gets the real one
+TRAILS = TrailSimplifier()
+
+
+def seed_positions(cur: Cursor):
+    global last_positions
+    last_positions = {
+        row[0]: tuple(row[1:]) for row in cur.execute("SELECT uuid, x, y, z, world FROM LatestPosition")
+    }
+
+
+def apply_update(cur: Cursor, conf: DynmapConfiguration, update_data: DynmapPlayerListing) -> List[str]:
+    """Write one tick of player positions. Returns the uuids of players who moved."""
+    global last_fix, last_positions, last_seen_flush, last_frame, frame_uuids
+    if last_positions is None:
+        seed_positions(cur)
+    now = time.time()
+    stamp = int(now)
+    worlds = {WORLDS.intern(world.internal) for world in conf.worlds}
+    frame = update_data.frame
+    base = last_frame if last_frame is not None else PlayerFrame()
+    diff = frame.diff(base)
+    changed = set(diff.moved)
+    changed.update(diff.joined)
+
+    moved: Dict[str, tuple] = {}
+    trail: List[tuple] = []
+    uuids: Dict[int, str] = {}
+    for row, account_id in enumerate(frame.ids):
+        if frame.worlds[row] not in worlds:
             continue  # not a world where positional data is provided
-        uuid = get_uuid(cur, player.account)
+        # standing still since the last frame, which was written: only last_seen changes
+        uuid = frame_uuids.get(account_id) if row not in changed else None
         if uuid is None:
-            continue
-        last_update = cur.execute(
-            "SELECT x, y, z, world FROM LatestPosition WHERE uuid=?", (uuid,)
-        ).fetchone()
-        cur.execute(
-            "INSERT OR REPLACE INTO LatestPosition (uuid, username, x, y, z, world) VALUES (?, ?, ?, ?, ?, ?)",
-            (uuid, player.account, player.x, player.y, player.z, player.world)
-        )
-        # get the last update
-        if last_update is None or last_update[0] != player.x or last_update[1] != player.y or last_update[2] != player.z or last_update[3] != player.world:
-            next_ord += 1
-            cur.execute(
-                "INSERT INTO Updates (ord, uuid, username, x, y, z, world) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (next_ord, uuid, player.account, player.x, player.y, player.z, player.world)
+            uuid = RESOLVER.resolve(cur, frame.account(row))
+            if uuid is None:
+                continue  # not known yet; the resolver will have it for a later tick
+            position = frame.position(row)
+            if last_positions.get(uuid) != position:
+                moved[uuid] = (uuid, frame.account(row), stamp) + position
+                trail.extend(TRAILS.add(moved[uuid]))
+        if uuid not in moved:
+            unflushed_seen.add(uuid)
+            trail.extend(TRAILS.still(uuid))
+        uuids[account_id] = uuid
+        last_seen[uuid] = now
+    trail.extend(TRAILS.end_tick(set(uuids.values())))
+    # held points are from the previous tick; keep ord in timestamp order
+    trail.sort(key=lambda r: r[2])
+
+    try:
+        if len(moved) > 0:
+            cur.executemany(
+                "INSERT INTO LatestPosition (uuid, username, timestamp, x, y, z, world) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (uuid) DO UPDATE SET username = excluded.username, timestamp = excluded.timestamp, "
+                "x = excluded.x, y = excluded.y, z = excluded.z, world = excluded.world",
+                list(moved.values())
+            )
+        if len(trail) > 0:
+            cur.executemany(
+                "INSERT INTO Updates (uuid, username, timestamp, x, y, z, world) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                trail
             )
-    last_fix = time.time()
+        if len(unflushed_seen) > 0 and now - last_seen_flush >= SEEN_FLUSH_INTERVAL:
+            cur.executemany(
+                "UPDATE LatestPosition SET timestamp = ? WHERE uuid = ?",
+                [(int(last_seen[uuid]), uuid) for uuid in unflushed_seen]
+            )
+            unflushed_seen.clear()
+            last_seen_flush = now
+    except Exception:
+        last_positions = None  # the transaction will be rolled back; re-seed next time
+        TRAILS.reset()
+        raise
+
+    for uuid, row in moved.items():
+        last_positions[uuid] = row[3:]
+        unflushed_seen.discard(uuid)
+    last_frame = frame
+    frame_uuids = uuids
+    update_data.diff = diff
+    update_data.base = base
+    last_fix = now
+    return list(moved.keys())
+
+
+def invalidate_moved(future: Future):
+    """Done-callback for an apply_update job: runs on the writer thread once it has committed."""
+    if not future.cancelled() and future.exception() is None:
+        REPORTS.invalidate(future.result())
+
+
+def submit_update(conf: DynmapConfiguration, pud: DynmapPlayerListing) -> Future:
+    """
+    Queue apply_update on the writer thread. Cached reports of players who moved are dropped there,
+    right after the commit, so that still happens if whoever is waiting on the result is cancelled.
+    """
+    future = get_database().submit(apply_update, conf, pud)
+    future.add_done_callback(invalidate_moved)
+    return future
 
 
 def auto_fetch(conf: DynmapConfiguration):
-    start = time.time()
-    upd = list(integration.get_updates(conf).values())[0]
-    pud = DynmapPlayerListing(upd)
+    with METRICS.timer('tracking_update'):
+        pud = integration.merge_players(integration.get_updates(conf))
+        submit_update(conf, pud).result()
+
+
+_update_client: Optional[integration.UpdateClient] = None
 
-    with player_connector() as conn:
-        cur = conn.cursor()
-        player_init_tables(cur)
-        apply_update(cur, conf, pud)
-        conn.commit()
-        cur.close()
-    stop = time.time()
-    print(f"Tracking update took {stop - start:.2f} seconds")
+
+async def auto_fetch_async(conf: DynmapConfiguration) -> Optional[DynmapPlayerListing]:
+    """
+    Same as auto_fetch, but every world is requested at once through the shared aiohttp session
+    and the database work is queued on the writer thread.
+    """
+    global _update_client
+    if _update_client is None or _update_client.conf is not conf:
+        _update_client = integration.UpdateClient(conf)
+    with METRICS.timer('tracking_update'):
+        pud = await _update_client.fetch_players()
+        if pud is None:
+            return None
+        await asyncio.wrap_future(submit_update(conf, pud))
+    return pud
 
 
 EASTER_EGG = {
@@ -148,80 +457,248 @@ def with_player_connection(fn):
     return wrapper
 
 
-def player_report(username: str):
-    start = time.time()
-    output = '&8' + EASTER_EGG.get(username.lower(), lambda: f"-")() + '&f\n'
-    with player_connector() as conn:
-        cur = conn.cursor()
+def format_dhms(timestamp: float) -> str:
+    days = int(timestamp // (60 * 60 * 24))
+    timestamp %= 60 * 60 * 24
+    hours = int(timestamp // (60 * 60))
+    timestamp %= 60 * 60
+    minutes = int(timestamp // 60)
+    timestamp %= 60
+    seconds = int(timestamp)
+
+    dhms = f"{days}d " if days > 0 else ""
+    dhms += f"{hours}h " if hours > 0 or len(dhms) > 0 else ""
+    dhms += f"{minutes}m " if minutes > 0 or len(dhms) > 0 else ""
+    dhms += f"{seconds}s"
+    return dhms
+
+
+# LatestPosition rows for \whereis, dropped by the tracker when the player moves
+REPORTS = ReportCache()
+
+
+def cached_position(username: str) -> Optional[Tuple[str, Position]]:
+    """(uuid, (x, y, z, world, timestamp)) for username if it's in memory, without touching p.db."""
+    hit, uuid = RESOLVER.cached(username)
+    if hit and uuid is not None:
+        latest = REPORTS.get(uuid)
+        if latest is not None:
+            return uuid, latest
+    return None
+
+
+def latest_position(username: str) -> Tuple[Optional[str], Optional[Position]]:
+    """(uuid, (x, y, z, world, timestamp)) for username, from memory if the player hasn't moved since last asked."""
+    found = cached_position(username)
+    if found is not None:
+        return found
+    version = REPORTS.version
+    with get_database().reader('latest_position') as cur:
+        uuid = RESOLVER.resolve(cur, username)
+        if uuid is None:
+            return None, None
+        latest = cur.execute("SELECT x, y, z, world, timestamp FROM LatestPosition WHERE uuid=?", (uuid,)).fetchone()
+    if latest is not None:
+        REPORTS.put(uuid, latest, version)
+    return uuid, latest
 
-        uuid = get_uuid(cur, username)
 
-        latest = cur.execute("SELECT x, y, z, world, timestamp FROM LatestPosition WHERE uuid=?", (uuid,)).fetchone()
-        if latest is None or uuid is None:
+def player_report(username: str, found: Tuple[Optional[str], Optional[Position]] = None) -> str:
+    """found is latest_position(username), if the caller already has it."""
+    with METRICS.timer('tracking_report'):
+        output = '&8' + EASTER_EGG.get(username.lower(), lambda: f"-")() + '&f\n'
+        uuid, latest = latest_position(username) if found is None else found
+        if latest is None:
             output += f"&cno data for {username}\n"
         else:
-            timestamp = datetime.strptime(latest[4], TSTAMP_FORMAT)
-
             # format days/hours/min/sec
-            timestamp = (datetime.utcnow() - timestamp).total_seconds()
+            timestamp = time.time() - latest[4]
+            if uuid in last_seen:
+                timestamp = min(timestamp, time.time() - last_seen[uuid])
 
             time_color_1 = "&7" if timestamp < 10 else "&e" if timestamp < 30 else "&c"
             time_color_2 = "&8" if timestamp < 10 else "&6" if timestamp < 30 else "&4"
-            days = int(timestamp // (60 * 60 * 24))
-            timestamp %= 60 * 60 * 24
-            hours = int(timestamp // (60 * 60))
-            timestamp %= 60 * 60
-            minutes = int(timestamp // 60)
-            timestamp %= 60
-            seconds = int(timestamp)
-
-            dhms = f"{days}d " if days > 0 else ""
-            dhms += f"{hours}h " if hours > 0 or len(dhms) > 0 else ""
-            dhms += f"{minutes}m " if minutes > 0 or len(dhms) > 0 else ""
-            dhms += f"{seconds}s"
+            dhms = format_dhms(timestamp)
             output += f"&a{username} {time_color_2}last seen {time_color_1}{dhms}{time_color_2} ago\n"
             output += f"&7(&c{latest[0]:.2f}&7, &c{latest[1]:.2f}&7, &c{latest[2]:.2f}&7) in &a{latest[3]}\n"
-        cur.close()
-    output += f"&8last update &7{time.time()-last_fix:.1f}s &8ago\n"
-    stop = time.time()
-    print(f"Tracking report took {stop - start:.2f} seconds")
-    rich_print(mc2rich(output))
+        output += f"&8last update &7{time.time()-last_fix:.1f}s &8ago\n"
     return output
 
 
+def resolve_stored(username: str) -> Optional[str]:
+    with get_database().reader('resolve') as cur:
+        return RESOLVER.resolve(cur, username)
+
+
+async def resolve_async(username: str) -> Optional[str]:
+    """Resolve a name someone is waiting on; names nobody has seen yet are looked up right away."""
+    hit, uuid = RESOLVER.cached(username)
+    if hit:
+        return uuid
+    uuid = await asyncio.get_running_loop().run_in_executor(None, resolve_stored, username)
+    if uuid is None and RESOLVER.is_pending(username):
+        uuid = await RESOLVER.wait(username)
+    return uuid
+
+
+async def player_report_async(username: str):
+    """
+    player_report, but names the resolver doesn't know yet are looked up first (without blocking).
+    Positions that aren't in memory are read in the default executor.
+    """
+    await resolve_async(username)
+    found = cached_position(username)
+    if found is None:
+        return await asyncio.get_running_loop().run_in_executor(None, player_report, username)
+    return player_report(username, found)
+
+
 def dbhealth_report() -> str:
     output = "&8-&f\n"
-    with player_connector() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM LatestPosition")
-        output += f"&a{cur.fetchone()[0]} &7players tracked\n"
-        cur.execute("SELECT COUNT(*) FROM Updates")
-        rows = cur.fetchone()[0]
+    with get_database().reader('dbhealth') as cur:
+        stats = dict(cur.execute("SELECT name, value FROM Stats"))
+        output += f"&a{stats['LatestPosition']} &7players tracked\n"
+        rows = stats['Updates']
         output += f"&a{rows} &7tracking updates ("
-        cur.execute("SELECT MAX(ord) FROM Updates")
-        last_id = cur.fetchone()[0]
+        # ord is the rowid, so this is one seek to the end of the table
+        last_id = cur.execute("SELECT MAX(ord) FROM Updates").fetchone()[0] or 0
         output += f"&a{last_id} &7last id)\n"
+        output += f"    &a{TRAILS.points_out} &7of &a{TRAILS.points_in} &7moves written since start\n"
         eff = rows / last_id if last_id > 0 else 0
         output += f"    &a{eff:03.2%} &7ID efficiency\n"
-        cur.execute("SELECT COUNT(*) FROM NameUUID")
-        output += f"&a{cur.fetchone()[0]} &7names tracked "
-        expired_names = 0
-        for row in cur.execute("SELECT last_refresh FROM NameUUID").fetchall():
-            exp = datetime.strptime(row[0], TSTAMP_FORMAT)
-            if (datetime.now() - exp).total_seconds() < OUTDATED_NAME_TIME:
-                expired_names += 1
+        output += f"&a{stats['NameUUID']} &7names tracked "
+        expired_names = cur.execute(
+            "SELECT COUNT(*) FROM NameUUID WHERE last_refresh <= ?", (int(time.time()) - OUTDATED_NAME_TIME,)
+        ).fetchone()[0]
         output += f"(&c{expired_names} &7expired)\n"
-        cur.close()
     rich_print(mc2rich(output))
     return output
 
 
+def ord_range(cur: Cursor, start: int, stop: int) -> Optional[Tuple[int, int]]:
+    """
+    Bounds on Updates.ord for start <= timestamp < stop, from UpdatesByTime.
+    ord grows with timestamp, so with these a per-player query can stay on UpdatesByPlayer.
+    """
+    first = cur.execute(
+        "SELECT ord FROM Updates WHERE timestamp >= ? ORDER BY timestamp LIMIT 1", (start,)
+    ).fetchone()
+    last = cur.execute(
+        "SELECT ord FROM Updates WHERE timestamp < ? ORDER BY timestamp DESC LIMIT 1", (stop,)
+    ).fetchone()
+    if first is None or last is None or first[0] > last[0]:
+        return None
+    return first[0], last[0]
+
+
+TrailPoint = namedtuple('TrailPoint', ['timestamp', 'x', 'y', 'z', 'world'])
+WorldSummary = namedtuple('WorldSummary', ['world', 'points', 'distance', 'x1', 'z1', 'x2', 'z2', 'first', 'last'])
+
+
+def player_trail(cur: Cursor, uuid: str, start: int, stop: int) -> Iterator[TrailPoint]:
+    """Positions of a player with start <= timestamp < stop, oldest first, including archived history."""
+    for row in retention.archived_updates(cur, uuid, start, stop):
+        yield TrailPoint(*row[3:])
+    bounds = ord_range(cur, start, stop)
+    if bounds is None:
+        return
+    rows = cur.execute(
+        "SELECT timestamp, x, y, z, world FROM Updates "
+        "WHERE uuid = ? AND ord BETWEEN ? AND ? AND timestamp >= ? AND timestamp < ? ORDER BY ord",
+        (uuid, bounds[0], bounds[1], start, stop)
+    )
+    for row in rows:
+        yield TrailPoint(*row)
+
+
+# Aggregated in SQLite; consecutive points only count towards distance when they are in the same world
+TRAIL_SUMMARY = """
+SELECT world, COUNT(*), COALESCE(SUM(CASE WHEN pw = world THEN sqrt((x - px) * (x - px) + (y - py) * (y - py) + (z - pz) * (z - pz)) END), 0),
+       MIN(x), MIN(z), MAX(x), MAX(z), MIN(timestamp), MAX(timestamp)
+FROM (
+    SELECT timestamp, x, y, z, world,
+           LAG(x) OVER w AS px, LAG(y) OVER w AS py, LAG(z) OVER w AS pz, LAG(world) OVER w AS pw
+    FROM Updates
+    WHERE uuid = ? AND ord BETWEEN ? AND ? AND timestamp >= ? AND timestamp < ?
+    WINDOW w AS (ORDER BY ord)
+)
+GROUP BY world
+ORDER BY MIN(timestamp)
+"""
+
+
+def trail_summary(cur: Cursor, uuid: str, start: int, stop: int) -> List[WorldSummary]:
+    """Per-world point count, distance travelled and bounding box, for rows still in p.db."""
+    bounds = ord_range(cur, start, stop)
+    if bounds is None:
+        return []
+    return [WorldSummary(*row) for row in cur.execute(TRAIL_SUMMARY, (uuid, bounds[0], bounds[1], start, stop))]
+
+
+def trail_report(username: str, duration: int) -> str:
+    output = '&8-&f\n'
+    stop = int(time.time()) + 1
+    with get_database().reader('trail') as cur:
+        uuid = RESOLVER.resolve(cur, username)
+        summary = trail_summary(cur, uuid, stop - duration, stop) if uuid is not None else []
+    if len(summary) == 0:
+        output += f"&cno movement for {username} in the last {format_dhms(duration)}\n"
+        return output
+    points = sum(world.points for world in summary)
+    distance = sum(world.distance for world in summary)
+    output += f"&a{username} &7moved &a{distance:.0f} &7blocks in the last &a{format_dhms(duration)} &8({points} points)\n"
+    for world in summary:
+        output += f"&7in &a{world.world}&7: &a{world.distance:.0f} &7blocks, " \
+                  f"&7(&c{world.x1:.0f}&7, &c{world.z1:.0f}&7) to (&c{world.x2:.0f}&7, &c{world.z2:.0f}&7)\n"
+    return output
+
+
+NEAR_QUERY = f"""
+SELECT u.uuid, MAX(u.username), u.world, COUNT(*), MIN(u.timestamp), MAX(u.timestamp)
+FROM UpdatesRTree r JOIN Updates u ON u.ord = r.ord
+WHERE r.x2 >= :x1 AND r.x1 <= :x2 AND r.z2 >= :z1 AND r.z1 <= :z2
+  AND r.t2 >= :start - {RTREE_EPOCH} AND r.t1 < :stop - {RTREE_EPOCH}
+  AND u.x BETWEEN :x1 AND :x2 AND u.z BETWEEN :z1 AND :z2 AND u.timestamp >= :start AND u.timestamp < :stop
+  AND (:world IS NULL OR u.world = :world)
+GROUP BY u.uuid, u.world
+ORDER BY MAX(u.timestamp) DESC
+LIMIT :limit
+"""
+
+Visit = namedtuple('Visit', ['uuid', 'username', 'world', 'points', 'first', 'last'])
+
+
+def players_near(cur: Cursor, x1: float, z1: float, x2: float, z2: float, start: int, stop: int,
+                 world: str = None, limit: int = 100) -> List[Visit]:
+    """
+    Players with a position inside the rectangle with start <= timestamp < stop, most recent first.
+    Goes through UpdatesRTree, so only rows near the area and time window are read. Archived history isn't included.
+    """
+    return [Visit(*row) for row in cur.execute(NEAR_QUERY, {
+        'x1': min(x1, x2), 'x2': max(x1, x2), 'z1': min(z1, z2), 'z2': max(z1, z2),
+        'start': start, 'stop': stop, 'world': world, 'limit': limit
+    })]
+
+
+def near_report(x: float, z: float, radius: float, duration: int, world: str = None) -> str:
+    output = '&8-&f\n'
+    now = int(time.time())
+    with get_database().reader('near') as cur:
+        visits = players_near(cur, x - radius, z - radius, x + radius, z + radius, now - duration, now + 1, world, limit=10)
+    if len(visits) == 0:
+        output += f"&cnobody within {radius:.0f} blocks of ({x:.0f}, {z:.0f}) in the last {format_dhms(duration)}\n"
+        return output
+    output += f"&7within &a{radius:.0f} &7blocks of (&c{x:.0f}&7, &c{z:.0f}&7) in the last &a{format_dhms(duration)}&7:\n"
+    for visit in visits:
+        output += f"&a{visit.username} &7in &a{visit.world}&7, last &a{format_dhms(now - visit.last)} &7ago\n"
+    return output
+
+
 if __name__ == '__main__':
     print('loading configuration')
     config = integration.get_configuration()
     print('downloading update data...')
-    updates = list(integration.get_updates(config).values())[0]
-    player_update_data = DynmapPlayerListing(updates)
+    player_update_data = integration.merge_players(integration.get_updates(config))
 
     print('starting database...')
     c = player_connector()
@@ -0,0 +1,151 @@
+"""
+Block change detection over watched chunks.
+
+The last unitified image of every watched chunk lives in one memory-mapped file (one UNIT_SIZE x UNIT_SIZE RGBA
+slot per chunk), so baselines survive restarts. A batch of fresh tiles is compared against its baselines as one
+stacked image: per-pixel difference, threshold, and a per-chunk count of changed pixels, all inside Pillow.
+"""
+import json
+import mmap
+import os
+import time
+from collections import namedtuple
+from typing import *
+
+from PIL import Image, ImageChops
+
+from spymap.structures import WatchedChunk, DynmapWorld, UNIT_SIZE
+
+SLOT_BYTES = UNIT_SIZE * UNIT_SIZE * 4
+GROW_SLOTS = 1024
+
+NOISE_THRESHOLD = 24  # per-channel difference below this is treated as noise (dynmap re-renders, compression)
+MIN_CHANGED_PIXELS = 2  # blocks that must change before a chunk reports a change
+
+ChunkChange = namedtuple('ChunkChange', ['world', 'chunk', 'changed'])
+
+
+class ChunkStore:
+    def __init__(self, path: str = 'chunks'):
+        """Baselines go in path + '.bin', the chunk -> slot index in path + '.json'."""
+        self.data_path = path + '.bin'
+        self.index_path = path + '.json'
+        self.slots: Dict[Tuple[str, int, int], int] = {}
+        # last time each chunk changed, used to refresh busy chunks first
+        self.changed_at: Dict[Tuple[str, int, int], float] = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for world, x, z, slot, *changed_at in json.load(f):
+                    self.slots[(world, x, z)] = slot
+                    if len(changed_at) > 0 and changed_at[0] is not None:
+                        self.changed_at[(world, x, z)] = changed_at[0]
+        if not os.path.exists(self.data_path):
+            open(self.data_path, 'wb').close()
+        self._file = open(self.data_path, 'r+b')
+        self._map: Optional[mmap.mmap] = None
+        self._capacity = 0
+        self._reserve(len(self.slots))
+
+    def _reserve(self, slots: int):
+        if slots <= self._capacity and self._map is not None:
+            return
+        capacity = max(slots + GROW_SLOTS - slots % GROW_SLOTS, os.path.getsize(self.data_path) // SLOT_BYTES)
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(capacity * SLOT_BYTES)
+        self._map = mmap.mmap(self._file.fileno(), capacity * SLOT_BYTES)
+        self._capacity = capacity
+
+    @staticmethod
+    def key(world: DynmapWorld, chunk: WatchedChunk) -> Tuple[str, int, int]:
+        return world.internal, chunk.x, chunk.z
+
+    def slot(self, world: DynmapWorld, chunk: WatchedChunk) -> Tuple[int, bool]:
+        """(slot, whether it already held a baseline)"""
+        key = self.key(world, chunk)
+        if key in self.slots:
+            return self.slots[key], True
+        slot = len(self.slots)
+        self._reserve(slot + 1)
+        self.slots[key] = slot
+        return slot, False
+
+    def priorities(self, world: DynmapWorld, chunks: Iterable[WatchedChunk]) -> Dict[WatchedChunk, float]:
+        """Fetch priorities for chunks: the most recently changed go first."""
+        return {
+            chunk: self.changed_at[self.key(world, chunk)] for chunk in chunks if self.key(world, chunk) in self.changed_at
+        }
+
+    def baselines(self, slots: List[int]) -> Image.Image:
+        """The stored images for slots, stacked like WatchedChunk.unitify_stack."""
+        if len(slots) > 0 and slots == list(range(slots[0], slots[0] + len(slots))):
+            raw = self._map[slots[0] * SLOT_BYTES:(slots[-1] + 1) * SLOT_BYTES]
+        else:
+            raw = b''.join(self._map[slot * SLOT_BYTES:(slot + 1) * SLOT_BYTES] for slot in slots)
+        return Image.frombytes('RGBA', (UNIT_SIZE, UNIT_SIZE * len(slots)), raw)
+
+    def store(self, slots: List[int], stack: Image.Image):
+        raw = stack.tobytes()
+        if len(slots) > 0 and slots == list(range(slots[0], slots[0] + len(slots))):
+            self._map[slots[0] * SLOT_BYTES:(slots[-1] + 1) * SLOT_BYTES] = raw
+            return
+        for i, slot in enumerate(slots):
+            self._map[slot * SLOT_BYTES:(slot + 1) * SLOT_BYTES] = raw[i * SLOT_BYTES:(i + 1) * SLOT_BYTES]
+
+    def flush(self):
+        self._map.flush()
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump([[*key, slot, self.changed_at.get(key)] for key, slot in self.slots.items()], f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def close(self):
+        self.flush()
+        self._map.close()
+        self._file.close()
+
+
+def load_watched(path: str) -> Dict[str, List[WatchedChunk]]:
+    """world -> chunks, from a JSON list of {"world": <internal name>, "x": <block x>, "z": <block z>}"""
+    watched: Dict[str, List[WatchedChunk]] = {}
+    if not os.path.exists(path):
+        return watched
+    with open(path) as f:
+        for entry in json.load(f):
+            chunk = WatchedChunk.from_coordinates(entry['x'], entry['z'])
+            chunks = watched.setdefault(entry['world'], [])
+            if chunk not in chunks:
+                chunks.append(chunk)
+    return watched
+
+
+def changed_pixels(before: Image.Image, after: Image.Image, threshold: int = NOISE_THRESHOLD) -> List[int]:
+    """Pixels differing by more than threshold in any channel, per UNIT_SIZE x UNIT_SIZE tile of two stacks."""
+    r, g, b, a = ImageChops.difference(before, after).split()
+    worst = ImageChops.lighter(ImageChops.lighter(r, g), ImageChops.lighter(b, a))
+    mask = worst.point(lambda v: 255 if v > threshold else 0)
+    # mean of a tile's mask is 255 * changed / pixels
+    means = mask.convert('F').reduce(UNIT_SIZE).getdata()
+    return [round(mean * UNIT_SIZE * UNIT_SIZE / 255) for mean in means]
+
+
+def detect_changes(store: ChunkStore, world: DynmapWorld, chunks: List[WatchedChunk], stack: Image.Image,
+                   threshold: int = NOISE_THRESHOLD, min_changed: int = MIN_CHANGED_PIXELS) -> List[ChunkChange]:
+    """
+    Compare freshly unitified chunks (stacked in the order of chunks) against their baselines,
+    then make them the new baselines. Chunks seen for the first time only record a baseline.
+    """
+    if len(chunks) == 0:
+        return []
+    slots, known = zip(*(store.slot(world, chunk) for chunk in chunks))
+    slots = list(slots)
+    counts = changed_pixels(store.baselines(slots), stack, threshold)
+    store.store(slots, stack)
+    changes = [
+        ChunkChange(world, chunk, count)
+        for chunk, was_known, count in zip(chunks, known, counts)
+        if was_known and count >= min_changed
+    ]
+    now = time.time()
+    for change in changes:
+        store.changed_at[store.key(world, change.chunk)] = now
+    return changes
@@ -0,0 +1,147 @@
+"""
+p.db connection management.
+
+All writes go through one long-lived connection owned by a single writer thread, fed by a queue.
+Reports read through a small pool of read-only connections, so with WAL they never wait on the tracker.
+"""
+import asyncio
+import math
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import *
+
+from metrics import METRICS
+
+DB_PATH = 'p.db'
+READERS = 4  # idle read-only connections kept open
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # safe with WAL; only the last commits can be lost on power failure
+    "PRAGMA cache_size=-16000",  # KiB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+def add_functions(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """Fill in math functions for SQLite builds without SQLITE_ENABLE_MATH_FUNCTIONS."""
+    try:
+        conn.execute("SELECT sqrt(1)")
+    except sqlite3.OperationalError:
+        conn.create_function('sqrt', 1, math.sqrt, deterministic=True)
+    return conn
+
+
+def configure(conn: sqlite3.Connection) -> sqlite3.Connection:
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return add_functions(conn)
+
+
+class PlayerDatabase:
+    def __init__(self, path: str = DB_PATH, init: Callable[..., Any] = None, readers: int = READERS):
+        self.path = path
+        self.init = init
+        self.readers = readers
+        self._idle_readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._jobs: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._start_error: Optional[BaseException] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='p.db-writer', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._start_error is not None:
+            raise self._start_error
+
+    def _run(self):
+        try:
+            conn = configure(sqlite3.connect(self.path))
+            if self.init is not None:
+                cur = conn.cursor()
+                self.init(cur)
+                conn.commit()
+                cur.close()
+        except BaseException as e:
+            self._start_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            fn, args, kwargs, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            cur = conn.cursor()
+            try:
+                with METRICS.timer('sql', statement=fn.__name__):
+                    ret = fn(cur, *args, **kwargs)
+                    conn.commit()
+            except BaseException as e:
+                conn.rollback()
+                future.set_exception(e)
+            else:
+                future.set_result(ret)
+            finally:
+                cur.close()
+        conn.close()
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """
+        Queue fn(<writer cursor>, *args, **kwargs) on the writer thread.
+        Each job runs in its own transaction, committed when fn returns.
+        """
+        self.start()
+        future = Future()
+        self._jobs.put((fn, args, kwargs, future))
+        return future
+
+    async def write(self, fn: Callable[..., Any], *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _connect_reader(self) -> sqlite3.Connection:
+        # pooled across the executor threads the reports run in, but only ever used by one at a time
+        conn = add_functions(sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False))
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @contextmanager
+    def reader(self, statement: str = 'read') -> Iterator[sqlite3.Cursor]:
+        """A cursor on a pooled read-only connection. Time spent inside is recorded under statement."""
+        self.start()
+        try:
+            conn = self._idle_readers.get_nowait()
+        except queue.Empty:
+            conn = self._connect_reader()
+        cur = conn.cursor()
+        try:
+            with METRICS.timer('sql', statement=statement):
+                yield cur
+        finally:
+            cur.close()
+            if conn.in_transaction:
+                conn.rollback()
+            if self._idle_readers.qsize() < self.readers:
+                self._idle_readers.put(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        while not self._idle_readers.empty():
+            self._idle_readers.get_nowait().close()
+        if self._thread is None:
+            return
+        self._jobs.put(None)
+        self._thread.join()
+        self._thread = None
+        self._ready.clear()
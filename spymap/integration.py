@@ -1,9 +1,12 @@
-import time
-from sqlite3 import connect
+import asyncio
+from typing import *
 
 import requests
+from aiohttp import ClientSession
 
-from spymap.structures import DynmapConfiguration
+from metrics import METRICS
+from spymap.structures import DynmapConfiguration, DynmapPlayerListing
+from spymap.tools import get_session
 
 CONFIGURATION_URL = 'https://dynmap.sc3.io/up/configuration'
 UPDATE_URL = 'https://dynmap.sc3.io/up/world/{}/{}'  # first {} is world, second {} is last update time
@@ -11,19 +14,67 @@ UPDATE_URL = 'https://dynmap.sc3.io/up/world/{}/{}'  # first {} is world, second
 
 def get_configuration():
     """Get the configuration from the configuration URL."""
-    response = requests.get(CONFIGURATION_URL)
+    with METRICS.timer('http', endpoint='dynmap_configuration'):
+        response = requests.get(CONFIGURATION_URL)
     return DynmapConfiguration(response.json())
 
 
-last_update = 0
+# world -> the server's timestamp from the last update we got for it
+last_update: Dict[str, int] = {}
 
 
 def get_updates(conf: DynmapConfiguration) -> dict:
     """Get updates from the update URL."""
-    global last_update
     responses = {}
     for world in conf.worlds:
-        response = requests.get(UPDATE_URL.format(world.internal, last_update))
+        with METRICS.timer('http', endpoint='dynmap_update'):
+            response = requests.get(UPDATE_URL.format(world.internal, last_update.get(world.internal, 0)))
         responses[world.internal] = response.json()
-    last_update = int(time.time())
+        last_update[world.internal] = responses[world.internal].get('timestamp', last_update.get(world.internal, 0))
     return responses
+
+
+def merge_players(updates: Dict[str, dict]) -> DynmapPlayerListing:
+    """One listing from every world's update, one entry per player."""
+    players = {}
+    for update in updates.values():
+        for player in update['players']:
+            players[player['account']] = player
+    return DynmapPlayerListing({'players': list(players.values())})
+
+
+class UpdateClient:
+    """
+    Incremental dynmap updates for every world, all requested at once.
+    Each world has its own cursor, taken from the server's timestamp in its last response.
+    """
+
+    def __init__(self, conf: DynmapConfiguration):
+        self.conf = conf
+        self.cursors: Dict[str, int] = {}
+
+    async def _fetch_world(self, session: ClientSession, world: str) -> dict:
+        with METRICS.timer('http', endpoint='dynmap_update'):
+            async with session.get(UPDATE_URL.format(world, self.cursors.get(world, 0))) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def fetch(self, session: ClientSession = None) -> Dict[str, dict]:
+        """world -> update, for the worlds that answered."""
+        session = session if session is not None else get_session()
+        worlds = [world.internal for world in self.conf.worlds]
+        results = await asyncio.gather(*[self._fetch_world(session, world) for world in worlds], return_exceptions=True)
+        updates = {}
+        for world, result in zip(worlds, results):
+            if isinstance(result, BaseException):
+                print(f'Update for {world} failed: {type(result).__name__}: {result}')
+                continue
+            updates[world] = result
+            self.cursors[world] = result.get('timestamp', self.cursors.get(world, 0))
+        return updates
+
+    async def fetch_players(self, session: ClientSession = None) -> Optional[DynmapPlayerListing]:
+        updates = await self.fetch(session)
+        if len(updates) == 0:
+            return None
+        return merge_players(updates)
@@ -0,0 +1,50 @@
+"""
+Latest positions of players people have asked about, kept in memory between ticks.
+
+apply_update reports which players moved once its transaction is committed, and their entries are dropped.
+A read that raced with such a commit may have seen the old row, so rows are only cached if nothing was
+invalidated while they were being read.
+"""
+import threading
+from collections import OrderedDict
+from typing import *
+
+CACHE_SIZE = 1024
+
+Position = Tuple[float, float, float, str, int]  # x, y, z, world, timestamp
+
+
+class ReportCache:
+    def __init__(self, capacity: int = CACHE_SIZE):
+        self.capacity = capacity
+        self.version = 0  # bumped by every invalidate()
+        self.hits = 0
+        self.misses = 0
+        self._rows: "OrderedDict[str, Position]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uuid: str) -> Optional[Position]:
+        with self._lock:
+            row = self._rows.get(uuid)
+            if row is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(uuid)
+            self.hits += 1
+            return row
+
+    def put(self, uuid: str, row: Position, version: int):
+        """Cache row, read after version was current; ignored if anything has moved since."""
+        with self._lock:
+            if version != self.version:
+                return
+            self._rows[uuid] = row
+            self._rows.move_to_end(uuid)
+            while len(self._rows) > self.capacity:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, uuids: Iterable[str]):
+        with self._lock:
+            self.version += 1
+            for uuid in uuids:
+                self._rows.pop(uuid, None)
@@ -0,0 +1,168 @@
+"""
+Name -> UUID resolution.
+
+Lookups go through an in-memory LRU (with expiry, and with negative entries for names Mojang doesn't know
+or failed to answer for), then the NameUUID table. Names that are still unknown are queued and looked up in
+bulk from Mojang by a background task, so the tracking tick never waits on the network.
+"""
+import asyncio
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from sqlite3 import Cursor
+from typing import *
+
+from metrics import METRICS
+from spymap import integration
+
+MOJANG_BULK_URL = 'https://api.mojang.com/profiles/minecraft'
+BULK_LIMIT = 10  # names per request, set by Mojang
+
+CACHE_SIZE = 4096
+POSITIVE_TTL = 60 * 60 * 24
+NEGATIVE_TTL = 60 * 60  # Mojang says the name doesn't exist
+FAILURE_TTL = 60  # Mojang didn't answer; try again soon
+BATCH_DELAY = 0.5  # wait this long for more names before sending a request
+
+CacheEntry = namedtuple('CacheEntry', ['uuid', 'expires'])
+
+
+class MojangBackend(ABC):
+    """Where bulk lookups go. Swap this out to point the resolver at a fake Mojang."""
+
+    @abstractmethod
+    async def lookup(self, names: List[str]) -> Dict[str, str]:
+        """
+        Look up at most BULK_LIMIT names at once.
+        Returns lowercase name -> uuid; names missing from the result don't exist.
+        Raises on failure.
+        """
+
+
+class AiohttpMojangBackend(MojangBackend):
+    def __init__(self, url: str = MOJANG_BULK_URL):
+        self.url = url
+
+    async def lookup(self, names: List[str]) -> Dict[str, str]:
+        with METRICS.timer('http', endpoint='mojang'):
+            async with integration.get_session().post(self.url, json=names) as response:
+                response.raise_for_status()
+                profiles = await response.json(content_type=None)
+        return {profile['name'].lower(): profile['id'] for profile in profiles}
+
+
+class NameResolver:
+    def __init__(self,
+                 db_lookup: Callable[[Cursor, str], Tuple[Optional[str], bool]],
+                 store: Callable[[List[Tuple[str, str]]], Any] = None,
+                 backend: MojangBackend = None,
+                 capacity: int = CACHE_SIZE):
+        """
+        db_lookup(cur, name) returns (uuid or None, whether it is fresh) from the database.
+        store([(uuid, name), ...]) persists names found by Mojang.
+        """
+        self.db_lookup = db_lookup
+        self.store = store
+        self.backend = backend if backend is not None else AiohttpMojangBackend()
+        self.capacity = capacity
+        self._cache: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._pending: Dict[str, str] = {}  # lowercase -> as given
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def cached(self, name: str) -> Tuple[bool, Optional[str]]:
+        """(hit, uuid) from memory only. A hit with uuid None is a negative entry."""
+        key = name.lower()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return False, None
+            if entry.expires < time.time():
+                del self._cache[key]
+                return False, None
+            self._cache.move_to_end(key)
+            return True, entry.uuid
+
+    def put(self, name: str, uuid: Optional[str], ttl: float):
+        key = name.lower()
+        with self._lock:
+            self._cache[key] = CacheEntry(uuid, time.time() + ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def resolve(self, cur: Cursor, name: str) -> Optional[str]:
+        """
+        Never blocks on the network. Unknown or stale names are queued for the background lookup;
+        stale names still resolve to their old uuid in the meantime.
+        """
+        hit, uuid = self.cached(name)
+        if hit:
+            return uuid
+        uuid, fresh = self.db_lookup(cur, name)
+        if fresh:
+            self.put(name, uuid, POSITIVE_TTL)
+            return uuid
+        self.request(name)
+        return uuid
+
+    def request(self, name: str):
+        with self._lock:
+            self._pending.setdefault(name.lower(), name)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def is_pending(self, name: str) -> bool:
+        with self._lock:
+            return name.lower() in self._pending
+
+    async def wait(self, name: str) -> Optional[str]:
+        """Resolve name right now (a single request), for when someone is waiting on the answer."""
+        hit, uuid = self.cached(name)
+        if hit:
+            return uuid
+        with self._lock:
+            self._pending.pop(name.lower(), None)
+        await self._lookup_batch([name])
+        return self.cached(name)[1]
+
+    async def _lookup_batch(self, names: List[str]):
+        try:
+            found = await self.backend.lookup(names)
+        except Exception as e:
+            print(f'Mojang lookup failed ({type(e).__name__}: {e}) for {len(names)} names')
+            for name in names:
+                self.put(name, None, FAILURE_TTL)
+            return
+        new = []
+        for name in names:
+            uuid = found.get(name.lower())
+            if uuid is None:
+                self.put(name, None, NEGATIVE_TTL)
+            else:
+                self.put(name, uuid, POSITIVE_TTL)
+                new.append((uuid, name))
+        if len(new) > 0 and self.store is not None:
+            self.store(new)
+
+    async def run(self):
+        """Background task draining queued names into bulk lookups."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        if len(self._pending) > 0:
+            self._wakeup.set()
+        try:
+            while True:
+                await self._wakeup.wait()
+                await asyncio.sleep(BATCH_DELAY)
+                self._wakeup.clear()
+                with self._lock:
+                    names = list(self._pending.values())
+                    self._pending.clear()
+                for i in range(0, len(names), BULK_LIMIT):
+                    await self._lookup_batch(names[i:i + BULK_LIMIT])
+        finally:
+            self._loop = None
+            self._wakeup = None
@@ -0,0 +1,140 @@
+"""
+Retention for Updates (movement history).
+
+- newer than RAW_WINDOW: every row is kept
+- older than that: downsampled to one row per player, world and DOWNSAMPLE_BUCKET seconds
+- older than ARCHIVE_AFTER: moved out of p.db, one gzipped CSV segment per UTC day, listed in ArchiveSegments
+
+Each step does a bounded amount of work in one writer transaction and records where it got to in Maintenance,
+so the tracker's writes interleave with a long catch-up.
+"""
+import csv
+import gzip
+import os
+import time
+from sqlite3 import Cursor
+from typing import *
+
+from spymap.db import PlayerDatabase
+
+DAY = 60 * 60 * 24
+RAW_WINDOW = 7 * DAY
+DOWNSAMPLE_BUCKET = 60
+DOWNSAMPLE_STEP = 60 * 60  # seconds of history per transaction
+ARCHIVE_AFTER = 90 * DAY
+ARCHIVE_DIR = 'archive'
+
+COLUMNS = ('ord', 'uuid', 'username', 'timestamp', 'x', 'y', 'z', 'world')
+
+
+def get_cursor(cur: Cursor, job: str) -> Optional[int]:
+    row = cur.execute("SELECT cursor FROM Maintenance WHERE job = ?", (job,)).fetchone()
+    return row[0] if row is not None else None
+
+
+def set_cursor(cur: Cursor, job: str, value: int):
+    cur.execute("INSERT OR REPLACE INTO Maintenance (job, cursor) VALUES (?, ?)", (job, value))
+
+
+def oldest_update(cur: Cursor) -> Optional[int]:
+    return cur.execute("SELECT MIN(timestamp) FROM Updates").fetchone()[0]
+
+
+def downsample_step(cur: Cursor, now: float) -> bool:
+    """Downsample the next DOWNSAMPLE_STEP seconds of history. Returns whether there is more to do."""
+    horizon = int(now - RAW_WINDOW) // DOWNSAMPLE_BUCKET * DOWNSAMPLE_BUCKET
+    lo = get_cursor(cur, 'downsample')
+    if lo is None:
+        lo = oldest_update(cur)
+        if lo is None:
+            return False
+        lo = lo // DOWNSAMPLE_BUCKET * DOWNSAMPLE_BUCKET
+    if lo >= horizon:
+        return False
+    hi = min(lo + DOWNSAMPLE_STEP, horizon)
+    cur.execute(
+        "DELETE FROM Updates WHERE timestamp >= :lo AND timestamp < :hi AND ord NOT IN ("
+        "SELECT MIN(ord) FROM Updates WHERE timestamp >= :lo AND timestamp < :hi "
+        "GROUP BY uuid, world, timestamp / :bucket)",
+        {'lo': lo, 'hi': hi, 'bucket': DOWNSAMPLE_BUCKET}
+    )
+    set_cursor(cur, 'downsample', hi)
+    return hi < horizon
+
+
+def segment_path(day: int) -> str:
+    return os.path.join(ARCHIVE_DIR, time.strftime('updates-%Y-%m-%d.csv.gz', time.gmtime(day * DAY)))
+
+
+def archive_step(cur: Cursor, now: float) -> bool:
+    """Move the next whole day older than ARCHIVE_AFTER into a segment file. Returns whether there is more to do."""
+    last_day = int(now - ARCHIVE_AFTER) // DAY  # days before this one are archivable
+    day = get_cursor(cur, 'archive')
+    if day is None:
+        oldest = oldest_update(cur)
+        if oldest is None:
+            return False
+        day = oldest // DAY
+    if day >= last_day:
+        return False
+    lo, hi = day * DAY, (day + 1) * DAY
+    rows = cur.execute(
+        f"SELECT {', '.join(COLUMNS)} FROM Updates WHERE timestamp >= ? AND timestamp < ? ORDER BY uuid, ord",
+        (lo, hi)
+    )
+    path = segment_path(day)
+    count = 0
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with gzip.open(path + '.tmp', 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    os.replace(path + '.tmp', path)
+    if count > 0:
+        cur.execute(
+            "INSERT OR REPLACE INTO ArchiveSegments (path, start, stop, rows) VALUES (?, ?, ?, ?)",
+            (path, lo, hi, count)
+        )
+        cur.execute("DELETE FROM Updates WHERE timestamp >= ? AND timestamp < ?", (lo, hi))
+    else:
+        os.remove(path)
+    set_cursor(cur, 'archive', day + 1)
+    return day + 1 < last_day
+
+
+def read_segment(path: str) -> Iterator[tuple]:
+    with gzip.open(path, 'rt', newline='') as f:
+        reader = csv.reader(f)
+        next(reader)  # header
+        for ord_, uuid, username, timestamp, x, y, z, world in reader:
+            yield int(ord_), uuid, username, int(timestamp), float(x), float(y), float(z), world
+
+
+def archived_updates(cur: Cursor, uuid: str, start: int, stop: int) -> Iterator[tuple]:
+    """Archived rows (COLUMNS) for one player with start <= timestamp < stop, oldest first."""
+    segments = cur.execute(
+        "SELECT path FROM ArchiveSegments WHERE start < ? AND stop > ? ORDER BY start", (stop, start)
+    ).fetchall()
+    for (path,) in segments:
+        found = False
+        for row in read_segment(path):
+            # segments are sorted by uuid
+            if row[1] != uuid:
+                if found:
+                    break
+                continue
+            found = True
+            if start <= row[3] < stop:
+                yield row
+
+
+async def apply_retention(database: PlayerDatabase):
+    """Catch up on downsampling and archiving, one step per writer job."""
+    start = time.time()
+    while await database.write(downsample_step, start):
+        pass
+    while await database.write(archive_step, start):
+        pass
+    print(f"Retention took {time.time() - start:.2f} seconds")
@@ -0,0 +1,105 @@
+"""
+Line simplification for the Updates trail, applied one tick at a time as positions come in.
+
+Each player's trail keeps an anchor (the last point written) and the points seen since. A new point extends
+the current segment as long as the straight line from the anchor to it passes within TOLERANCE blocks of all
+of them. When it doesn't, the previous point is a corner and is written. Points within MIN_MOVE of the last
+kept point are jitter and are dropped. Stopping, leaving, and changing world all write the point they happened
+at. Written points are never more than MAX_SPAN blocks apart, so every position seen is within REACH blocks of
+one. Spatial queries over Updates only see players passing through if they look at least that far around a spot;
+\\near won't take a smaller radius.
+
+A held point is always from the previous tick, so rows still go into Updates in timestamp order.
+"""
+from math import sqrt
+from typing import *
+
+MIN_MOVE = 1.0  # blocks; closer than this to the last kept point is jitter
+TOLERANCE = 2.0  # blocks a dropped point may be from the simplified line
+MAX_SPAN = 48.0  # blocks between written points, at most
+MAX_POINTS = 32  # points one segment may stand in for
+REACH = MAX_SPAN / 2 + TOLERANCE  # blocks from any position seen to the nearest written point, at most
+
+# Updates rows: (uuid, username, timestamp, x, y, z, world)
+Row = Tuple[str, str, int, float, float, float, str]
+
+
+def distance(a: Row, b: Row) -> float:
+    return sqrt((a[3] - b[3]) ** 2 + (a[4] - b[4]) ** 2 + (a[5] - b[5]) ** 2)
+
+
+def off_line(p: Row, a: Row, b: Row) -> float:
+    """Distance from p to the segment a-b"""
+    dx, dy, dz = b[3] - a[3], b[4] - a[4], b[5] - a[5]
+    length = dx * dx + dy * dy + dz * dz
+    t = 0.0 if length == 0 else max(0.0, min(1.0, ((p[3] - a[3]) * dx + (p[4] - a[4]) * dy + (p[5] - a[5]) * dz) / length))
+    return sqrt((p[3] - a[3] - t * dx) ** 2 + (p[4] - a[4] - t * dy) ** 2 + (p[5] - a[5] - t * dz) ** 2)
+
+
+class Track:
+    def __init__(self, anchor: Row):
+        self.anchor = anchor
+        self.held: Optional[Row] = None  # the latest point, not written yet
+        self.window: List[Row] = []  # points since anchor, ending with held
+
+
+class TrailSimplifier:
+    def __init__(self, min_move: float = MIN_MOVE, tolerance: float = TOLERANCE, max_span: float = MAX_SPAN,
+                 max_points: int = MAX_POINTS):
+        self.min_move = min_move
+        self.tolerance = tolerance
+        self.max_span = max_span
+        self.max_points = max_points
+        self.tracks: Dict[str, Track] = {}
+        self.points_in = 0
+        self.points_out = 0
+
+    def _emit(self, rows: List[Row]) -> List[Row]:
+        self.points_out += len(rows)
+        return rows
+
+    def _release(self, track: Track) -> List[Row]:
+        """Write the held point and make it the anchor."""
+        if track.held is None:
+            return []
+        held = track.held
+        track.anchor, track.held, track.window = held, None, []
+        return self._emit([held])
+
+    def add(self, row: Row) -> List[Row]:
+        """A player moved to row. Returns the rows to write to Updates now."""
+        self.points_in += 1
+        uuid, world = row[0], row[6]
+        track = self.tracks.get(uuid)
+        if track is None or track.anchor[6] != world:
+            out = self._release(track) if track is not None else []
+            self.tracks[uuid] = Track(row)
+            return out + self._emit([row])
+        if distance(track.held or track.anchor, row) < self.min_move:
+            return self._release(track)
+        if track.held is None:
+            track.held, track.window = row, [row]
+            return []
+        if distance(track.anchor, row) > self.max_span or len(track.window) >= self.max_points \
+                or any(off_line(p, track.anchor, row) > self.tolerance for p in track.window):
+            out = self._release(track)
+            track.held, track.window = row, [row]
+            return out
+        track.window.append(row)
+        track.held = row
+        return []
+
+    def still(self, uuid: str) -> List[Row]:
+        """A player is online but hasn't moved."""
+        track = self.tracks.get(uuid)
+        return self._release(track) if track is not None else []
+
+    def end_tick(self, seen: Set[str]) -> List[Row]:
+        """Write out and forget everyone not in seen (offline, or somewhere untracked)."""
+        out = []
+        for uuid in [uuid for uuid in self.tracks if uuid not in seen]:
+            out.extend(self._release(self.tracks.pop(uuid)))
+        return out
+
+    def reset(self):
+        self.tracks.clear()
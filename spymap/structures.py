@@ -1,17 +1,21 @@
 """
 watch v1.1 - the "spy on your friends" dynmap interface
 """
+import asyncio
 import base64
 import json
+from array import array
 from collections import namedtuple
 from io import BytesIO
 from math import floor
 from typing import *
 
-from PIL import Image, ImageStat
-from aiohttp import ClientSession
+from PIL import Image
+from spymap.tools import FetchScheduler, SCHEDULER
 
-from spymap.tools import get_batch
+TILE_SIZE = 128  # dynmap tile, pixels
+UNIT_SIZE = 32  # unitified tile, pixels
+UNITIFY_BATCH = 256  # decoded tiles held at once while fetching a group
 
 DynmapWorld = namedtuple('DynmapWorld', ['internal', 'external'])
 
@@ -26,14 +30,118 @@ class DynmapConfiguration:
         ))
 
 
-def drop_excess(block: dict, fds: list):
-    return {k: v for k, v in block.items() if k in fds}
+class Interner:
+    """Stable small integers for names. Ids are never reused, so they can be compared between frames."""
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+
+    def intern(self, name: str) -> int:
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def __getitem__(self, i: int) -> str:
+        return self.names[i]
+
+    def __len__(self):
+        return len(self.names)
+
+
+ACCOUNTS = Interner()
+WORLDS = Interner()
+
+# moved and joined are rows of the newer frame; left are rows of the older one
+FrameDiff = namedtuple('FrameDiff', ['moved', 'joined', 'left'])
+
+
+class PlayerFrame:
+    """
+    One tick of players, stored column by column and sorted by account id.
+    Account and world ids come from ACCOUNTS and WORLDS. Players without an account aren't kept.
+    """
+
+    def __init__(self, ids: array = None, x: array = None, y: array = None, z: array = None, worlds: array = None):
+        self.ids = ids if ids is not None else array('l')
+        self.x = x if x is not None else array('d')
+        self.y = y if y is not None else array('d')
+        self.z = z if z is not None else array('d')
+        self.worlds = worlds if worlds is not None else array('l')
+
+    @classmethod
+    def from_players(cls, players: Iterable[dict]) -> 'PlayerFrame':
+        """From the 'players' list of a dynmap update"""
+        rows = {}
+        for player in players:
+            account = player.get('account')
+            if account is None:
+                continue
+            i = ACCOUNTS.intern(account)
+            rows[i] = (i, player['x'], player['y'], player['z'], WORLDS.intern(player['world']))
+        if len(rows) == 0:
+            return cls()
+        ids, x, y, z, worlds = zip(*sorted(rows.values()))
+        return cls(array('l', ids), array('d', x), array('d', y), array('d', z), array('l', worlds))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def account(self, row: int) -> str:
+        return ACCOUNTS[self.ids[row]]
+
+    def world(self, row: int) -> str:
+        return WORLDS[self.worlds[row]]
+
+    def position(self, row: int) -> Tuple[float, float, float, str]:
+        return self.x[row], self.y[row], self.z[row], WORLDS[self.worlds[row]]
+
+    def player(self, row: int) -> DynmapPlayer:
+        return DynmapPlayer(WORLDS[self.worlds[row]], self.x[row], self.y[row], self.z[row], ACCOUNTS[self.ids[row]])
+
+    def diff(self, previous: 'PlayerFrame') -> FrameDiff:
+        """Who moved, joined and left since previous, in one merge over both frames' columns."""
+        if self.ids == previous.ids and self.x == previous.x and self.z == previous.z \
+                and self.y == previous.y and self.worlds == previous.worlds:
+            return FrameDiff([], [], [])  # the usual quiet tick; every comparison above runs in C
+        moved, joined, left = [], [], []
+        i, j = 0, 0
+        n, m = len(self.ids), len(previous.ids)
+        while i < n and j < m:
+            a, b = self.ids[i], previous.ids[j]
+            if a == b:
+                if self.x[i] != previous.x[j] or self.z[i] != previous.z[j] or self.y[i] != previous.y[j] \
+                        or self.worlds[i] != previous.worlds[j]:
+                    moved.append(i)
+                i += 1
+                j += 1
+            elif a < b:
+                joined.append(i)
+                i += 1
+            else:
+                left.append(j)
+                j += 1
+        joined.extend(range(i, n))
+        left.extend(range(j, m))
+        return FrameDiff(moved, joined, left)
 
 
 class DynmapPlayerListing:
-    # noinspection PyTypeChecker
     def __init__(self, player_data: dict):
-        self.players: Tuple[DynmapPlayer, ...] = tuple(map(lambda x: DynmapPlayer(**drop_excess(x, DynmapPlayer._fields)), player_data['players']))
+        self.frame = PlayerFrame.from_players(player_data['players'])
+        # set by apply_update: diff is frame.diff(base), base being the last frame it wrote
+        self.diff: Optional[FrameDiff] = None
+        self.base: Optional[PlayerFrame] = None
+        self._players: Optional[Tuple[DynmapPlayer, ...]] = None
+
+    @property
+    def players(self) -> Tuple[DynmapPlayer, ...]:
+        """Row by row, for code that wants one player at a time"""
+        if self._players is None:
+            self._players = tuple(self.frame.player(row) for row in range(len(self.frame)))
+        return self._players
 
 
 class WatchedChunk:
@@ -61,22 +169,94 @@ class WatchedChunk:
 
     @staticmethod
     def unitify(chunk_image: Image.Image):
-        result = Image.new('RGBA', (32, 32))
+        return WatchedChunk.unitify_batch([chunk_image])[0]
+
+    @staticmethod
+    def unitify_stack(chunk_images: "List[Image.Image]") -> Image.Image:
+        """
+        Average every 4x4 block of each tile, for a whole batch of tiles at once.
+        The tiles are stacked on top of each other and each band is box-reduced as floats, which truncate
+        back to the same values ImageStat's means did. Returns one UNIT_SIZE x (UNIT_SIZE * n) RGBA image.
+        """
+        if len(chunk_images) == 0:
+            return Image.new('RGBA', (UNIT_SIZE, 0))
+        stack = Image.new('RGBA', (TILE_SIZE, TILE_SIZE * len(chunk_images)))
+        for i, chunk_image in enumerate(chunk_images):
+            stack.paste(chunk_image.convert('RGBA'), (0, TILE_SIZE * i))
+        bands = [band.convert('F').reduce(TILE_SIZE // UNIT_SIZE).convert('L') for band in stack.split()]
+        return Image.merge('RGBA', bands)
 
-        for x in range(32):
-            for z in range(32):
-                block = chunk_image.crop((x * 4, z * 4, x * 4 + 4, z * 4 + 4))
-                average = ImageStat.Stat(block).mean
-                result.putpixel((x, z), tuple(map(int, average)))
+    @staticmethod
+    def unitify_batch(chunk_images: "List[Image.Image]") -> "List[Image.Image]":
+        units = WatchedChunk.unitify_stack(chunk_images)
+        return [units.crop((0, UNIT_SIZE * i, UNIT_SIZE, UNIT_SIZE * (i + 1))) for i in range(len(chunk_images))]
 
-        return result
+    @staticmethod
+    async def fetch_tiles(group: "List[WatchedChunk]", world: DynmapWorld, priorities: "Dict[WatchedChunk, float]" = None,
+                          scheduler: FetchScheduler = SCHEDULER) -> "AsyncIterator[Tuple[WatchedChunk, Image.Image]]":
+        """
+        Stream (chunk, tile) as tiles arrive, higher priority chunks first.
+        Tiles that can't be fetched or decoded are skipped.
+        """
+        by_url = {chunk.get_url(world): chunk for chunk in group}
+        url_priorities = {} if priorities is None else {
+            chunk.get_url(world): priority for chunk, priority in priorities.items()
+        }
+        async for result in scheduler.stream(list(by_url), url_priorities):
+            if result.error is not None:
+                print(f'Tile fetch failed: {result.error}')
+                continue
+            try:
+                tile = Image.open(BytesIO(result.data))
+                tile.load()
+            except (OSError, SyntaxError) as e:
+                print(f'Bad tile from {result.url}: {e}')
+                continue
+            yield by_url[result.url], tile
+
+    @staticmethod
+    def join_stacks(stacks: "List[Image.Image]") -> Image.Image:
+        """Concatenate unit stacks from unitify_stack, top to bottom."""
+        joined = Image.new('RGBA', (UNIT_SIZE, sum(stack.height for stack in stacks)))
+        top = 0
+        for stack in stacks:
+            joined.paste(stack, (0, top))
+            top += stack.height
+        return joined
+
+    @staticmethod
+    async def fetch_stack(group: "List[WatchedChunk]", world: DynmapWorld, priorities: "Dict[WatchedChunk, float]" = None,
+                          scheduler: FetchScheduler = SCHEDULER,
+                          batch: int = UNITIFY_BATCH) -> "Tuple[List[WatchedChunk], Image.Image]":
+        """
+        Fetch and unitify a group of chunks. Returns the chunks that arrived and their stacked units.
+        Tiles are unitified in the default executor, batch at a time, as they arrive; only their units are kept.
+        """
+        loop = asyncio.get_running_loop()
+        chunks, tiles, stacks = [], [], []
+        pending = None  # at most one batch being unitified while the next one is fetched
+        async for chunk, tile in WatchedChunk.fetch_tiles(group, world, priorities, scheduler):
+            chunks.append(chunk)
+            tiles.append(tile)
+            if len(tiles) >= batch:
+                if pending is not None:
+                    stacks.append(await pending)
+                pending = loop.run_in_executor(None, WatchedChunk.unitify_stack, tiles)
+                tiles = []
+        if pending is not None:
+            stacks.append(await pending)
+        if tiles:
+            stacks.append(await loop.run_in_executor(None, WatchedChunk.unitify_stack, tiles))
+        if len(stacks) == 1:
+            return chunks, stacks[0]
+        return chunks, await loop.run_in_executor(None, WatchedChunk.join_stacks, stacks)
 
     @staticmethod
-    async def fetch_group(group: "List[WatchedChunk]"):
-        async with ClientSession() as session:
-            responses = await get_batch(list(map(lambda chunk: chunk.get_url(), group)), session)
-        responses = list(map(lambda response: (response[0], Image.open(BytesIO(response[1]))), responses))
-        return list(map(lambda response: (response[0], WatchedChunk.unitify(response[1])), responses))
+    async def fetch_group(group: "List[WatchedChunk]", world: DynmapWorld):
+        chunks, stack = await WatchedChunk.fetch_stack(group, world)
+        return [
+            (chunk, stack.crop((0, UNIT_SIZE * i, UNIT_SIZE, UNIT_SIZE * (i + 1)))) for i, chunk in enumerate(chunks)
+        ]
 
 
 class ZoneRect(namedtuple("ZoneRect", ['x1', 'z1', 'x2', 'z2'])):
@@ -85,21 +265,19 @@ class ZoneRect(namedtuple("ZoneRect", ['x1', 'z1', 'x2', 'z2'])):
 
 
 class Zone:
-    def __init__(self, name: str, rects: List[ZoneRect], players: List[str] = None):
+    def __init__(self, name: str, rects: List[ZoneRect], players: Iterable[str] = None):
         self.name = name
         self.rects = rects
-        self.players_inside = [] if players is None else players
+        self.players_inside: Set[str] = set() if players is None else set(players)
 
     def is_within(self, x, z):
         return any(map(lambda rect: rect.is_within(x, z), self.rects))
 
     def add_player(self, player):
-        if player not in self.players_inside:
-            self.players_inside.append(player)
+        self.players_inside.add(player)
 
     def remove_player(self, player):
-        if player in self.players_inside:
-            self.players_inside.remove(player)
+        self.players_inside.discard(player)
 
     # Not protected; name begins with _ to prevent name conflicts in namedtuple
     # noinspection PyProtectedMember
@@ -107,7 +285,7 @@ class Zone:
         return {
             'name': self.name,
             'rects': list(map(lambda rect: rect._asdict(), self.rects)),
-            'players_inside': self.players_inside
+            'players_inside': sorted(self.players_inside)
         }
 
     @classmethod
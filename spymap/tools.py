@@ -1,6 +1,38 @@
 import asyncio
+import heapq
+import random
+import time
+from collections import namedtuple
 from typing import *
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError
+
+from metrics import METRICS
+
+SESSION_LIMIT = 16
+SESSION_TIMEOUT = 10
+
+_session: Optional[ClientSession] = None
+
+
+def get_session() -> ClientSession:
+    """
+    Get the shared aiohttp session, creating it on first use.
+    Must be called from inside the running event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = ClientSession(
+            connector=TCPConnector(limit=SESSION_LIMIT, ttl_dns_cache=300),
+            timeout=ClientTimeout(total=SESSION_TIMEOUT)
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
 
 
 async def get(url: str, session: ClientSession) -> bytes:
@@ -11,9 +43,124 @@ async def get(url: str, session: ClientSession) -> bytes:
         return await response.read()
 
 
-async def get_batch(urls: List[str], session: ClientSession) -> List[Tuple[str, bytes]]:
+async def get_batch(urls: List[str], session: ClientSession = None) -> List[Tuple[str, bytes]]:
     """
-    Get a batch of *thing*s from the given URLs.
+    Get a batch of *thing*s from the given URLs, through the shared FetchScheduler.
+    Failed URLs are left out.
     """
-    responses = await asyncio.gather(*[get(url, session) for url in urls])
-    return list(zip(urls, responses))
+    scheduler = SCHEDULER if session is None else FetchScheduler(session=session)
+    responses = {}
+    async for result in scheduler.stream(urls):
+        if result.error is None:
+            responses[result.url] = result.data
+    return [(url, responses[url]) for url in urls if url in responses]
+
+
+FetchResult = namedtuple('FetchResult', ['url', 'data', 'error'])
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    def __init__(self, url: str, reason: str, retry: bool):
+        super().__init__(f'{url}: {reason}')
+        self.retry = retry
+
+
+class RateLimiter:
+    """Token bucket: at most rate requests per second, with bursts of up to burst."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FetchScheduler:
+    """
+    Fetches URLs over one pooled session, with at most concurrency requests in flight and rate requests
+    per second across everything using this scheduler. Requests time out after timeout seconds and are
+    retried (with exponential backoff) on timeouts, connection errors and 429/5xx.
+    """
+
+    def __init__(self, concurrency: int = 8, rate: float = 20, timeout: float = 10, retries: int = 3,
+                 backoff: float = 0.5, session: ClientSession = None, endpoint: str = 'dynmap_tile'):
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate, burst=concurrency)
+        self.timeout = ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = session
+        self.endpoint = endpoint  # for metrics
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def _attempt(self, url: str) -> bytes:
+        session = self.session if self.session is not None else get_session()
+        await self.limiter.acquire()
+        try:
+            with METRICS.timer('http', endpoint=self.endpoint):
+                async with session.get(url, timeout=self.timeout) as response:
+                    if response.status != 200:
+                        raise FetchError(url, f'HTTP {response.status}', response.status in RETRY_STATUS)
+                    return await response.read()
+        except (ClientError, asyncio.TimeoutError) as e:
+            raise FetchError(url, f'{type(e).__name__}: {e}', True)
+
+    async def fetch(self, url: str) -> FetchResult:
+        async with self._get_semaphore():
+            for attempt in range(self.retries + 1):
+                try:
+                    return FetchResult(url, await self._attempt(url), None)
+                except FetchError as e:
+                    if not e.retry or attempt == self.retries:
+                        return FetchResult(url, None, e)
+                await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+
+    async def stream(self, urls: Iterable[str], priorities: Dict[str, float] = None) -> AsyncIterator[FetchResult]:
+        """
+        Fetch urls, yielding results as they complete.
+        URLs with a higher priority are requested first; the rest keep their order.
+        """
+        priorities = priorities if priorities is not None else {}
+        pending = [(-priorities.get(url, 0), i, url) for i, url in enumerate(urls)]
+        heapq.heapify(pending)
+        total = len(pending)
+        results: "asyncio.Queue[FetchResult]" = asyncio.Queue()
+
+        async def worker():
+            while len(pending) > 0:
+                _, _, url = heapq.heappop(pending)
+                try:
+                    result = await self.fetch(url)
+                except Exception as e:
+                    result = FetchResult(url, None, e)
+                await results.put(result)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, total))]
+        try:
+            for _ in range(total):
+                yield await results.get()
+        finally:
+            for task in workers:
+                task.cancel()
+
+
+SCHEDULER = FetchScheduler()
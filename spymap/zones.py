@@ -0,0 +1,129 @@
+"""
+Zone engine: every ZoneRect of every zone in one uniform grid, and per-tick enter/exit detection.
+
+Each tick only looks at the rows of the frame diff (players who moved, joined or left), and each lookup
+only checks the rects in the player's grid cell.
+"""
+import json
+import os
+from collections import defaultdict, namedtuple
+from math import floor
+from typing import *
+
+from spymap.structures import Zone, ZoneRect, PlayerFrame, FrameDiff, WORLDS
+
+GRID_CELL = 256  # blocks
+
+ENTER = 'enter'
+EXIT = 'exit'
+
+ZoneEvent = namedtuple('ZoneEvent', ['kind', 'zone', 'player'])
+
+
+class ZoneIndex:
+    def __init__(self, cell: int = GRID_CELL):
+        self.cell = cell
+        self.cells: Dict[Tuple[int, int], List[Tuple[Zone, ZoneRect]]] = defaultdict(list)
+
+    def _cells(self, rect: ZoneRect) -> Iterator[Tuple[int, int]]:
+        x1, x2 = sorted((rect.x1, rect.x2))
+        z1, z2 = sorted((rect.z1, rect.z2))
+        for cx in range(floor(x1 / self.cell), floor(x2 / self.cell) + 1):
+            for cz in range(floor(z1 / self.cell), floor(z2 / self.cell) + 1):
+                yield cx, cz
+
+    def add(self, zone: Zone):
+        for rect in zone.rects:
+            for key in self._cells(rect):
+                self.cells[key].append((zone, rect))
+
+    def remove(self, zone: Zone):
+        for rect in zone.rects:
+            for key in self._cells(rect):
+                entries = [entry for entry in self.cells[key] if entry[0] is not zone]
+                if len(entries) > 0:
+                    self.cells[key] = entries
+                else:
+                    del self.cells[key]
+
+    def zones_at(self, x: float, z: float) -> Set[Zone]:
+        entries = self.cells.get((floor(x / self.cell), floor(z / self.cell)))
+        if entries is None:
+            return set()
+        return {zone for zone, rect in entries if rect.is_within(x, z)}
+
+
+class ZoneEngine:
+    def __init__(self, zones: Iterable[Zone] = (), world: str = None, cell: int = GRID_CELL):
+        """Zones only apply in world (an internal dynmap world name); None for every world."""
+        self.world = world
+        self.world_id = WORLDS.intern(world) if world is not None else None
+        self.index = ZoneIndex(cell)
+        self.zones: List[Zone] = []
+        self.frame = PlayerFrame()  # the frame of the last tick
+        self.inside: Dict[str, Set[Zone]] = {}
+        for zone in zones:
+            self.add_zone(zone)
+
+    def add_zone(self, zone: Zone):
+        self.zones.append(zone)
+        self.index.add(zone)
+
+    def remove_zone(self, zone: Zone):
+        self.zones.remove(zone)
+        self.index.remove(zone)
+        for zones in self.inside.values():
+            zones.discard(zone)
+
+    def locate(self, frame: PlayerFrame, row: int) -> Set[Zone]:
+        if self.world_id is not None and frame.worlds[row] != self.world_id:
+            return set()
+        return self.index.zones_at(frame.x[row], frame.z[row])
+
+    def _move(self, account: str, after: Set[Zone], events: List[ZoneEvent]):
+        before = self.inside.get(account, set())
+        if after == before:
+            return
+        for zone in after - before:
+            zone.add_player(account)
+            events.append(ZoneEvent(ENTER, zone, account))
+        for zone in before - after:
+            zone.remove_player(account)
+            events.append(ZoneEvent(EXIT, zone, account))
+        if len(after) > 0:
+            self.inside[account] = after
+        else:
+            self.inside.pop(account, None)
+
+    def tick(self, frame: PlayerFrame, diff: FrameDiff = None, base: PlayerFrame = None) -> List[ZoneEvent]:
+        """
+        diff is frame.diff(base), as apply_update already worked it out. It's only used if base is the frame
+        this engine saw last; otherwise (a tick it missed, or no diff) frame is diffed here.
+        Players who left (or went somewhere dynmap doesn't show) leave every zone.
+        """
+        if diff is None or base is not self.frame:
+            diff = frame.diff(self.frame)
+        events = []
+        for row in diff.left:
+            self._move(self.frame.account(row), set(), events)
+        for rows in (diff.moved, diff.joined):
+            for row in rows:
+                self._move(frame.account(row), self.locate(frame, row), events)
+        self.frame = frame
+        return events
+
+    def dump(self) -> list:
+        return [zone.dump() for zone in self.zones]
+
+
+def load_zones(path: str) -> List[Zone]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [Zone.load(data) for data in json.load(f)]
+
+
+def save_zones(path: str, zones: Iterable[Zone]):
+    with open(path + '.tmp', 'w') as f:
+        json.dump([zone.dump() for zone in zones], f)
+    os.replace(path + '.tmp', path)